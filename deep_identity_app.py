@@ -6,27 +6,89 @@
 # Требования:
 # - streamlit
 # - openai (для генерации отчёта; если нет — приложение всё равно работает, но без отчёта)
+# - pyarrow (опционально, в requirements.txt не входит: выгрузка истории в Parquet; без него — CSV)
 #
 # Secrets (Streamlit Cloud → App settings → Secrets):
 # OPENAI_API_KEY="sk-..."
 # MASTER_PASSWORD="your_password"
 # (опционально) OPENAI_MODEL="gpt-5.1"
+# (опционально) OPENAI_BASE_URL / OPENAI_TIMEOUT=120 / OPENAI_MAX_RETRIES=2
+# (опционально) REPORT_BACKEND="openai"  # openai / local (REPORT_LOCAL_URL, REPORT_LOCAL_MODEL) / stub
+# (опционально) REPORT_CACHE_MAX_MB=50   # дисковый кэш отчётов (LRU по размеру)
+# (опционально) REPORT_TOKEN_BUDGET=9000  # потолок токенов промпта отчёта
+# (опционально) REPORT_JOB_WORKERS=2      # параллельных фоновых генераций отчёта
+# (опционально) RESULTS_STORAGE="sqlite"  # json (по умолчанию) / jsonl / sqlite
+#
+# Служебные команды (без UI):
+# python deep_identity_app.py migrate-jsonl   # перенос JSON-массива в JSONL
+# python deep_identity_app.py migrate-sqlite  # перенос JSON-массива в SQLite
+# python deep_identity_app.py compact-jsonl   # схлопнуть версии записей в JSONL
+# python deep_identity_app.py compact-events  # законченные, но не сохранённые сессии из журналов — в хранилище
+# python deep_identity_app.py rescore [--dry-run]  # пересчитать scores всей истории после смены весов
+# python deep_identity_app.py bulk-reports --concurrency 4  # черновики для всех сессий без отчёта
+# python deep_identity_app.py export --out history.zip [--format csv]  # sessions + answers в Parquet/CSV
+# python deep_identity_app.py bench-writes --storage json --n 300 --threads 32 --processes 4
+# python deep_identity_app.py bench-session-memory --sessions 200
+# python deep_identity_app.py bench-load --sizes 1000,5000,10000  # пиковая память: json.load vs потоковое чтение
+# python deep_identity_app.py bench-tables [--synthetic 2000]  # таблицы 3×3 по всей истории
+# python deep_identity_app.py bench-openai --n 50
+# python deep_identity_app.py bench-reports --backend local --n 100 --concurrency 8 --delay-ms 200
+# python deep_identity_app.py bench-reports --backend local --n 100 --rate-limit-every 7  # повторы клиента на 429
 
 import os
+import sys
 import json
+import argparse
+import sqlite3
 import uuid
+import asyncio
+import hashlib
+import zipfile
+import time
+import tempfile
+import subprocess
+import threading
+import re
+import random
 import itertools
-from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Any, Tuple
+import heapq
+from collections import OrderedDict, deque
+import tracemalloc
+from dataclasses import dataclass, field, replace
+from types import MappingProxyType
+from typing import Dict, List, Optional, Any, Callable, Tuple, Mapping, Iterable, Iterator, Sequence, TextIO
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
 
+import numpy as np
+import pandas as pd
 import streamlit as st
 
+# --- fcntl (только POSIX; без него остаётся блокировка внутри процесса) ---
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore
+
 # --- OpenAI (опционально) ---
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+    RETRYABLE_OPENAI_ERRORS: Tuple[type, ...] = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
 except Exception:
     OpenAI = None  # type: ignore
+    AsyncOpenAI = None  # type: ignore
+    RETRYABLE_OPENAI_ERRORS = ()
+
+# --- pyarrow (опционально: выгрузка истории в Parquet; без него — CSV) ---
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None  # type: ignore
+    pq = None  # type: ignore
 
 
 # ============================
@@ -34,50 +96,668 @@ except Exception:
 # ============================
 
 RESULTS_FILE = "deep_identity_results.json"
+RESULTS_JSONL_FILE = "deep_identity_results.jsonl"
+RESULTS_DB_FILE = "deep_identity_results.sqlite"
+REPORT_JOBS_DB_FILE = "deep_identity_report_jobs.sqlite"
 
 
 def _now_iso() -> str:
     return datetime.now().isoformat(timespec="seconds")
 
 
-def ensure_results_file():
-    if not os.path.exists(RESULTS_FILE):
-        with open(RESULTS_FILE, "w", encoding="utf-8") as f:
-            json.dump([], f, ensure_ascii=False, indent=2)
+def get_setting(name: str, default: str = "") -> str:
+    """Значение из st.secrets, затем из переменных окружения."""
+    try:
+        v = st.secrets.get(name, "")
+        if v:
+            return str(v)
+    except Exception:
+        pass
+    return os.environ.get(name, default)
 
 
-def load_results() -> List[Dict[str, Any]]:
-    ensure_results_file()
+RESULTS_STORAGES = ("json", "jsonl", "sqlite")
+
+
+def results_storage() -> str:
+    """
+    Бэкенд хранения результатов (secret/env RESULTS_STORAGE):
+    - "json"   — один JSON-массив в RESULTS_FILE (по умолчанию);
+    - "jsonl"  — append-only лог в RESULTS_JSONL_FILE, 1 строка = 1 запись;
+    - "sqlite" — RESULTS_DB_FILE, поиск записи по id через PRIMARY KEY.
+    """
+    mode = get_setting("RESULTS_STORAGE", "json").strip().lower()
+    return mode if mode in RESULTS_STORAGES else "json"
+
+
+@st.cache_resource
+def _results_thread_lock(path: str) -> threading.RLock:
+    # через cache_resource: модуль заново исполняется на каждом rerun,
+    # а замок должен быть один на процесс для всех сессий
+    return threading.RLock()
+
+
+@contextmanager
+def results_write_lock(path: str):
+    """
+    Сериализует писателей файла path: RLock внутри процесса
+    + flock на path + ".lock" между процессами (если есть fcntl).
+    """
+    with _results_thread_lock(os.path.abspath(path)):
+        if fcntl is None:
+            yield
+            return
+        with open(path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write_text(path: str, text: str) -> None:
+    """Пишет во временный файл рядом и подменяет path через os.replace."""
+    atomic_write_chunks(path, [text])
+
+
+def atomic_write_chunks(path: str, chunks: Iterable[str]) -> None:
+    """Как atomic_write_text, но текст приходит частями (не собирается в памяти целиком)."""
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                               dir=os.path.dirname(os.path.abspath(path)))
     try:
-        with open(RESULTS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if isinstance(data, list):
-            return data
-        return []
-    except Exception:
-        return []
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.writelines(chunks)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _file_version(path: str) -> Tuple[int, int]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (0, 0)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+JSON_STREAM_CHUNK = 1 << 16
+_JSON_WS = re.compile(r"[ \t\n\r]*")
+
+
+def iter_json_array(f: TextIO, chunk_size: int = JSON_STREAM_CHUNK) -> Iterator[Any]:
+    """
+    Элементы JSON-массива из файла по одному: raw_decode по скользящему буферу,
+    в памяти — текущий элемент и кусок файла, а не весь массив.
+    Не массив / битый или обрезанный файл — ValueError (после уже отданных элементов).
+    """
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    pos = 0
+    eof = not buf
+
+    def more(n: int) -> None:
+        nonlocal buf, pos, eof
+        data = f.read(n)
+        eof = not data
+        buf = buf[pos:] + data
+        pos = 0
+
+    def next_char() -> str:
+        # следующий непробельный символ ("" — конец файла), pos указывает на него
+        nonlocal pos
+        while True:
+            pos = _JSON_WS.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            more(chunk_size)
+
+    if next_char() != "[":
+        raise ValueError("JSON array expected")
+    pos += 1
+    first = True
+    while True:
+        ch = next_char()
+        if ch == "]":
+            return
+        if not first:
+            if ch != ",":
+                raise ValueError(f"',' or ']' expected, got {ch!r}")
+            pos += 1
+            next_char()
+        first = False
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # запись длиннее буфера — читаем вдвое больше, чтобы не разбирать её заново много раз
+                more(max(chunk_size, len(buf) - pos))
+                continue
+            if not eof and type(item) in (int, float):
+                # число могло оборваться на границе куска ("1." → 1): ждём разделитель после него
+                nxt = _JSON_WS.match(buf, end).end()
+                if nxt == len(buf) or buf[nxt] not in ",]":
+                    more(chunk_size)
+                    continue
+            break
+        pos = end
+        yield item
+
+
+def project_fields(item: Dict[str, Any], fields: Sequence[str]) -> Dict[str, Any]:
+    """Только нужные поля записи; "a.b" — вложенное (scores.combined_total). Отсутствующие пропускаются."""
+    out: Dict[str, Any] = {}
+    for path in fields:
+        keys = path.split(".")
+        value: Any = item
+        for k in keys:
+            if not isinstance(value, dict) or k not in value:
+                break
+            value = value[k]
+        else:
+            _set_path(out, keys, value)
+    return out
+
+
+def _set_path(out: Dict[str, Any], keys: List[str], value: Any) -> None:
+    for k in keys[:-1]:
+        out = out.setdefault(k, {})
+    out[keys[-1]] = value
+
+
+def json_array_chunks(items: Iterable[Any]) -> Iterator[str]:
+    """Тот же текст, что json.dumps(list(items), ensure_ascii=False, indent=2), но по элементу."""
+    sep = "[\n  "
+    for item in items:
+        # переводы строк внутри строковых значений экранированы — \n здесь только разметка
+        yield sep + json.dumps(item, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+        sep = ",\n  "
+    yield "[]" if sep == "[\n  " else "\n]"
+
+
+class ResultsStore:
+    """
+    Интерфейс хранилища сессий. get по умолчанию — полный проход.
+    iter_all(fields) отдаёт записи по одной; fields — проекция (см. project_fields).
+    """
+
+    path: str = ""
+
+    def version(self) -> Tuple[int, ...]:
+        """Меняется при любой записи — ключ для кэшей поверх хранилища."""
+        return _file_version(self.path)
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def append(self, item: Dict[str, Any]) -> None:
+        """Идемпотентно по id: повторный append той же записи заменяет её, а не дублирует."""
+        raise NotImplementedError
+
+    def update(self, item: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def iter_all(self, fields: Optional[Sequence[str]] = None) -> Iterator[Dict[str, Any]]:
+        for item in self.load_all():
+            yield item if fields is None else project_fields(item, fields)
+
+    def read_since(self, cursor: Any) -> Tuple[List[Dict[str, Any]], Any, bool]:
+        """
+        Записи, появившиеся после cursor (None — с начала): (записи, новый курсор, reset).
+        reset=True — продолжить с курсора нельзя (файл переписан), в записях всё хранилище.
+        Обновлённая запись может прийти повторно с тем же id — побеждает последняя.
+        По умолчанию курсор — число записей; старые записи читаются потоком и не хранятся.
+        """
+        if cursor is not None:
+            out: List[Dict[str, Any]] = []
+            count = 0
+            for count, item in enumerate(self.iter_all(), start=1):
+                if count > cursor:
+                    out.append(item)
+            if count >= cursor:
+                return out, count, False
+        # первое чтение или история стала короче (переписана) — всё заново
+        data = list(self.iter_all())
+        return data, len(data), True
+
+    def update_many(self, items: List[Dict[str, Any]]) -> None:
+        for item in items:
+            self.update(item)
+
+    def modify_many(self, ids: Iterable[str], fn: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]) -> int:
+        """
+        Чтение-проверка-запись: fn(текущая версия) → новая версия или None (не трогать).
+        Бэкенды делают это под одним замком записи, чтобы между проверкой и записью
+        никто не успел сохранить свою версию. Возвращает число записанных.
+        """
+        fresh = [new for new in (fn(x) for x in map(self.get, ids) if x is not None) if new is not None]
+        self.update_many(fresh)
+        return len(fresh)
+
+    def get(self, rid: str) -> Optional[Dict[str, Any]]:
+        for x in self.iter_all():
+            if x.get("id") == rid:
+                return x
+        return None
+
+
+class JsonResultsStore(ResultsStore):
+    def __init__(self, path: str = RESULTS_FILE):
+        self.path = path
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        # файл подменяется целиком (os.replace), поэтому читать можно без замка
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, list):
+                return data
+            return []
+        except Exception:
+            return []
+
+    def _iter_strict(self) -> Iterator[Dict[str, Any]]:
+        """
+        Для путей записи: битый/обрезанный файл — ValueError, а не молча укороченная
+        история (иначе перезапись навсегда потеряет всё после места поломки).
+        """
+        try:
+            f = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            for item in iter_json_array(f):
+                if isinstance(item, dict):
+                    yield item
+
+    def iter_all(self, fields: Optional[Sequence[str]] = None) -> Iterator[Dict[str, Any]]:
+        # потоковое чтение массива: память не растёт с историей
+        try:
+            for item in self._iter_strict():
+                yield item if fields is None else project_fields(item, fields)
+        except ValueError:
+            # битый/обрезанный файл: load_all в этом случае отдаёт [], здесь — то, что успели прочитать
+            return
+
+    def read_since(self, cursor: Any) -> Tuple[List[Dict[str, Any]], Any, bool]:
+        # файл переписывается целиком при любой записи (в том числе update на месте),
+        # так что дочитывать нечего: новая версия — это всегда вся история заново
+        items = list(self.iter_all())
+        return items, len(items), True
+
+    def _write(self, items: Iterable[Dict[str, Any]]) -> None:
+        atomic_write_chunks(self.path, json_array_chunks(items))
+
+    def append(self, item: Dict[str, Any]) -> None:
+        # перезапись потоком: старый файл читается по записи, новый пишется рядом;
+        # запись с тем же id заменяется на месте (в jsonl побеждает последняя строка, в sqlite — INSERT OR REPLACE)
+        rid = item.get("id")
+
+        def upsert() -> Iterator[Dict[str, Any]]:
+            found = False
+            for x in self._iter_strict():
+                if rid is not None and x.get("id") == rid:
+                    found = True
+                    yield item
+                else:
+                    yield x
+            if not found:
+                yield item
+
+        with results_write_lock(self.path):
+            self._write(upsert())
+
+    def update(self, item: Dict[str, Any]) -> None:
+        self.update_many([item])
+
+    def update_many(self, items: List[Dict[str, Any]]) -> None:
+        by_id = {x.get("id"): x for x in items}
+        with results_write_lock(self.path):
+            self._write(by_id.get(x.get("id"), x) for x in self._iter_strict())
+
+    def modify_many(self, ids: Iterable[str], fn: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]) -> int:
+        # get по id здесь — тот же проход по файлу, так что проверка идёт прямо в перезаписи
+        wanted = set(ids)
+        written = 0
+
+        def apply() -> Iterator[Dict[str, Any]]:
+            nonlocal written
+            for x in self._iter_strict():
+                new = fn(x) if x.get("id") in wanted else None
+                written += new is not None
+                yield x if new is None else new
+
+        with results_write_lock(self.path):
+            self._write(apply())
+        return written
+
+
+class JsonlResultsStore(ResultsStore):
+    """
+    update дописывает новую версию записи, поэтому при чтении
+    побеждает последняя строка с данным id (порядок — по первому появлению id).
+    """
+
+    def __init__(self, path: str = RESULTS_JSONL_FILE):
+        self.path = path
+
+    def _read_lines(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return []
+        out = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # недописанная строка (падение посреди записи) — пропускаем
+                    continue
+                if isinstance(item, dict):
+                    out.append(item)
+        return out
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        by_id: Dict[str, Dict[str, Any]] = {}
+        no_id: List[Dict[str, Any]] = []
+        for item in self._read_lines():
+            rid = item.get("id")
+            if rid is None:
+                no_id.append(item)
+            else:
+                by_id[rid] = item
+        return list(by_id.values()) + no_id
+
+    def iter_all(self, fields: Optional[Sequence[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Тот же результат и порядок, что load_all, но в памяти только смещения:
+        1-й проход — id → смещение последней версии, 2-й — чтение этих строк.
+        """
+        latest: Dict[str, int] = {}
+        no_id: List[int] = []
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            offset = 0
+            for line in f:
+                start, offset = offset, offset + len(line)
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(item, dict):
+                    continue
+                rid = item.get("id")
+                if rid is None:
+                    no_id.append(start)
+                else:
+                    latest[rid] = start
+            for start in itertools.chain(latest.values(), no_id):
+                f.seek(start)
+                item = json.loads(f.readline())
+                yield item if fields is None else project_fields(item, fields)
+
+    def append(self, item: Dict[str, Any]) -> None:
+        line = json.dumps(item, ensure_ascii=False) + "\n"
+        with results_write_lock(self.path):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def update(self, item: Dict[str, Any]) -> None:
+        self.append(item)
+
+    def update_many(self, items: List[Dict[str, Any]]) -> None:
+        with results_write_lock(self.path):
+            self._append_many(items)
+
+    def _append_many(self, items: List[Dict[str, Any]]) -> None:
+        text = "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def modify_many(self, ids: Iterable[str], fn: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]) -> int:
+        wanted = set(ids)
+        with results_write_lock(self.path):
+            # один проход по логу: последняя версия каждой нужной записи
+            current = {x["id"]: x for x in self.iter_all() if x.get("id") in wanted}
+            fresh = [new for new in map(fn, current.values()) if new is not None]
+            self._append_many(fresh)
+        return len(fresh)
+
+    def read_since(self, cursor: Any) -> Tuple[List[Dict[str, Any]], Any, bool]:
+        # курсор — (inode, смещение в байтах): дочитываем только хвост лога;
+        # compact подменяет файл (новый inode) — тогда читаем заново
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return [], None, cursor is not None
+        reset = cursor is None or cursor[0] != stat.st_ino or cursor[1] > stat.st_size
+        offset = 0 if reset else cursor[1]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            chunk = f.read()
+        # недописанную последнюю строку оставляем на следующий раз
+        end = chunk.rfind(b"\n") + 1
+        out = []
+        for line in chunk[:end].splitlines():
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(item, dict):
+                out.append(item)
+        return out, (stat.st_ino, offset + end), reset
+
+    def compact(self) -> int:
+        """Переписывает файл, оставляя по одной (последней) версии каждой записи."""
+        with results_write_lock(self.path):
+            data = self.load_all()
+            atomic_write_text(self.path, "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in data))
+        return len(data)
+
+
+class SqliteResultsStore(ResultsStore):
+    """
+    Запись целиком лежит JSON-ом в колонке data; id / created_at / client_name
+    вынесены в колонки (id — PRIMARY KEY), поэтому get/update
+    не разбирают и не переписывают всю историю. seq растёт при каждой записи
+    строки (и вставке, и UPDATE) — по нему read_since видит изменения на месте.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS results ("
+        " id TEXT PRIMARY KEY,"
+        " created_at TEXT,"
+        " client_name TEXT,"
+        " data TEXT NOT NULL,"
+        " seq INTEGER)",
+        # поиск по имени/дате идёт по кэшированному индексу мастер-панели (filter_session_index),
+        # так что индексы по created_at/client_name ничего не ускоряли, а запись замедляли
+        "DROP INDEX IF EXISTS idx_results_created_at",
+        "DROP INDEX IF EXISTS idx_results_client_name",
+    )
+
+    def __init__(self, path: str = RESULTS_DB_FILE):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+            if "seq" not in {r[1] for r in conn.execute("PRAGMA table_info(results)")}:
+                # база до seq: порядок записей тот же, что у rowid
+                conn.execute("ALTER TABLE results ADD COLUMN seq INTEGER")
+                conn.execute("UPDATE results SET seq = rowid")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_results_seq ON results(seq)")
+
+    def version(self) -> Tuple[int, ...]:
+        # в WAL-режиме запись сначала попадает в "-wal", основной файл меняется при checkpoint
+        return _file_version(self.path) + _file_version(self.path + "-wal")
+
+    # вычисляется внутри пишущего запроса, то есть под замком записи sqlite
+    _NEXT_SEQ = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM results)"
+
+    def _connect(self) -> sqlite3.Connection:
+        # соединение на операцию: sqlite3-соединения привязаны к потоку,
+        # а Streamlit обслуживает каждого клиента в своём потоке
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _row(item: Dict[str, Any]) -> Tuple[Any, ...]:
+        return (item.get("id"), item.get("created_at") or "", item.get("client_name") or "",
+                json.dumps(item, ensure_ascii=False))
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT data FROM results ORDER BY rowid").fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def append(self, item: Dict[str, Any]) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO results (id, created_at, client_name, data, seq) "
+                         f"VALUES (?, ?, ?, ?, {self._NEXT_SEQ})", self._row(item))
+
+    def update(self, item: Dict[str, Any]) -> None:
+        self.update_many([item])
+
+    def modify_many(self, ids: Iterable[str], fn: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]) -> int:
+        with closing(self._connect()) as conn, conn:
+            # IMMEDIATE — замок записи берётся до чтения, поиск по PRIMARY KEY
+            conn.execute("BEGIN IMMEDIATE")
+            fresh = []
+            for rid in ids:
+                row = conn.execute("SELECT data FROM results WHERE id = ?", (rid,)).fetchone()
+                new = fn(json.loads(row[0])) if row else None
+                if new is not None:
+                    fresh.append(self._row(new))
+            conn.executemany("UPDATE results SET created_at = ?, client_name = ?, data = ?, "
+                             f"seq = {self._NEXT_SEQ} WHERE id = ?",
+                             [(created_at, client_name, data, rid) for rid, created_at, client_name, data in fresh])
+        return len(fresh)
+
+    def update_many(self, items: List[Dict[str, Any]]) -> None:
+        rows = [self._row(item) for item in items]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("UPDATE results SET created_at = ?, client_name = ?, data = ?, "
+                             f"seq = {self._NEXT_SEQ} WHERE id = ?",
+                             [(created_at, client_name, data, rid) for rid, created_at, client_name, data in rows])
+
+    def iter_all(self, fields: Optional[Sequence[str]] = None) -> Iterator[Dict[str, Any]]:
+        if fields:
+            # проекция в самой sqlite: json_extract по путям, из базы приходит маленький JSON-массив
+            paths = ["$." + ".".join(f'"{k}"' for k in f.split(".")) for f in fields]
+            sql = ("SELECT json_array(" + ", ".join("json_extract(data, ?)" for _ in paths) + ")"
+                   " FROM results ORDER BY rowid")
+        else:
+            sql, paths = "SELECT data FROM results ORDER BY rowid", []
+        with closing(self._connect()) as conn:
+            cur = conn.execute(sql, paths)
+            while True:
+                rows = cur.fetchmany(500)
+                if not rows:
+                    break
+                for r in rows:
+                    if not fields:
+                        yield json.loads(r[0])
+                        continue
+                    # null = поля нет (как в project_fields)
+                    out: Dict[str, Any] = {}
+                    for f, value in zip(fields, json.loads(r[0])):
+                        if value is not None:
+                            _set_path(out, f.split("."), value)
+                    yield out
+
+    def read_since(self, cursor: Any) -> Tuple[List[Dict[str, Any]], Any, bool]:
+        # курсор — последний seq: новые и обновлённые (UPDATE) строки идут после него
+        with closing(self._connect()) as conn:
+            last = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM results").fetchone()[0]
+            reset = cursor is None or last < cursor
+            rows = conn.execute("SELECT data FROM results WHERE seq > ? ORDER BY seq",
+                                (0 if reset else cursor,)).fetchall()
+        return [json.loads(r[0]) for r in rows], last, reset
+
+    def get(self, rid: str) -> Optional[Dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT data FROM results WHERE id = ?", (rid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+RESULTS_STORE_FILES = {"json": RESULTS_FILE, "jsonl": RESULTS_JSONL_FILE, "sqlite": RESULTS_DB_FILE}
+
+
+@st.cache_resource
+def _results_store(mode: str, path: str) -> ResultsStore:
+    # один объект на (режим, файл) на процесс: у sqlite схема и PRAGMA — только при первом открытии
+    if mode == "jsonl":
+        return JsonlResultsStore(path)
+    if mode == "sqlite":
+        return SqliteResultsStore(path)
+    return JsonResultsStore(path)
+
+
+def make_results_store(mode: str) -> ResultsStore:
+    mode = mode if mode in RESULTS_STORE_FILES else "json"
+    # ключ — абсолютный путь: относительное имя файла зависит от текущего каталога
+    return _results_store(mode, os.path.abspath(RESULTS_STORE_FILES[mode]))
+
+
+def get_results_store() -> ResultsStore:
+    return make_results_store(results_storage())
+
+
+def load_results() -> List[Dict[str, Any]]:
+    return get_results_store().load_all()
+
+
+def iter_results(fields: Optional[Sequence[str]] = None) -> Iterator[Dict[str, Any]]:
+    """Сессии по одной, без загрузки всей истории; fields — проекция, например ("id", "client_name")."""
+    return get_results_store().iter_all(fields)
+
+
+def get_result(rid: str) -> Optional[Dict[str, Any]]:
+    return get_results_store().get(rid)
 
 
 def append_result(item: Dict[str, Any]) -> None:
-    ensure_results_file()
-    data = load_results()
-    data.append(item)
-    with open(RESULTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    get_results_store().append(item)
 
 
 def update_result(updated_item: Dict[str, Any]) -> None:
-    ensure_results_file()
-    data = load_results()
-    rid = updated_item.get("id")
-    out = []
-    for x in data:
-        if x.get("id") == rid:
-            out.append(updated_item)
-        else:
-            out.append(x)
-    with open(RESULTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
+    get_results_store().update(updated_item)
+
+
+def migrate_results(target: ResultsStore) -> int:
+    """
+    Разовый перенос RESULTS_FILE (JSON-массив) в другой бэкенд.
+    Записи, чьи id уже есть в target, пропускаются — повторный запуск безопасен.
+    Исходный файл не трогаем. Возвращает число перенесённых записей.
+    """
+    if not os.path.exists(RESULTS_FILE):
+        return 0
+    known = {x.get("id") for x in target.iter_all(["id"])}
+    moved = 0
+    for item in JsonResultsStore().iter_all():
+        if item.get("id") in known:
+            continue
+        target.append(item)
+        moved += 1
+    return moved
 
 
 # ============================
@@ -121,49 +801,135 @@ POT_MEANING = {
     "SHUNGIT": "Тело, сила, выносливость, физическая опора, действие через тело.",
 }
 
+# Для шаблонного отчёта: потребность / боль-ловушка / как наполняет (ряд 2) / как дозировать (ряд 3)
+POT_NEED = {
+    "AMETIST": "Время и тишина, чтобы думать; сложные задачи, где нужна глубина.",
+    "SAPFIR": "Понимать «зачем»; дело, которое совпадает с внутренним вектором.",
+    "GELIODOR": "Живой обмен с людьми: объяснять, учить, соединять.",
+    "GRANAT": "Отклик и внимание: видеть, как твои эмоции зажигают других.",
+    "CITRIN": "Измеримый результат, победа, деньги как счёт в игре.",
+    "IZUMRUD": "Красота и гармония вокруг; возможность заботиться.",
+    "YANTAR": "Порядок, предсказуемость, система, в которой всё работает.",
+    "RUBIN": "Новизна, движение, события, регулярный «перезапуск».",
+    "SHUNGIT": "Движение и нагрузка для тела; ощущение физической силы.",
+}
+
+POT_PAIN = {
+    "AMETIST": "Уход в анализ без действия, «горе от ума», одиночество в мыслях.",
+    "SAPFIR": "Потеря смысла → апатия; бесконечный поиск «своего».",
+    "GELIODOR": "Распыление на всех, разговоры вместо результата.",
+    "GRANAT": "Зависимость от реакции, эмоциональные качели.",
+    "CITRIN": "Гонка за цифрами и выгорание, обесценивание всего, что не приносит денег.",
+    "IZUMRUD": "Перфекционизм в мелочах, забота о других в ущерб себе.",
+    "YANTAR": "Гиперконтроль, тревога, когда что-то идёт не по плану.",
+    "RUBIN": "Скука и рутина убивают; бросает начатое ради нового.",
+    "SHUNGIT": "Без движения — тяжесть и раздражение; загоняет тело «через силу».",
+}
+
+POT_FILL = {
+    "AMETIST": "чтение, разборы, шахматы/стратегии — как отдых, а не работа",
+    "SAPFIR": "практики осмысления, дневник, разговоры «о главном»",
+    "GELIODOR": "встречи с людьми, обучение других, комьюнити",
+    "GRANAT": "сцена, выступления, творчество с откликом",
+    "CITRIN": "игры на результат, соревнования, маленькие победы",
+    "IZUMRUD": "красивые места, уют дома, забота о растениях/животных",
+    "YANTAR": "наведение порядка, планирование, режим",
+    "RUBIN": "поездки, новые места, события, смена обстановки",
+    "SHUNGIT": "регулярный спорт, прогулки, физическая нагрузка",
+}
+
+POT_DELEGATE = {
+    "AMETIST": "глубокую аналитику отдавать партнёру/эксперту, себе — готовые выводы",
+    "SAPFIR": "не требовать от себя «миссии» в каждом деле; сверять смысл раз в квартал",
+    "GELIODOR": "нетворк и переписку — ассистенту; общение дозировать по дням",
+    "GRANAT": "публичность — коротко и по сценарию; эмоциональную работу делить с командой",
+    "CITRIN": "продажи и переговоры — партнёру, себе — понятные цели без гонки",
+    "IZUMRUD": "оформление и эстетику — дизайнеру; не шлифовать детали до идеала",
+    "YANTAR": "учёт, документы, регламенты — бухгалтеру/операционисту",
+    "RUBIN": "командировки и ивенты — дозированно; рутину не превращать в «экстрим»",
+    "SHUNGIT": "физическую работу — тем, кому она в радость; себе — умеренная нагрузка",
+}
+
+# теги вариантов ответа → как называть в отчёте
+TAG_LABEL = {
+    "sport": "спорт/тело",
+    "thinking": "мышление/анализ",
+    "money": "деньги/результат",
+    "stage": "сцена/влияние",
+    "care": "забота",
+    "system": "порядок/система",
+    "network": "люди/общение",
+    "beauty": "красота/эстетика",
+    "adrenaline": "адреналин/новизна",
+    "meaning": "смысл/миссия",
+}
+
 # ============================
 # OpenAI клиент (только для отчёта)
 # ============================
 
-def get_openai_client() -> Optional[Any]:
-    if OpenAI is None:
-        return None
-    api_key = None
-    try:
-        api_key = st.secrets.get("OPENAI_API_KEY", None)
-    except Exception:
-        api_key = None
-    if not api_key:
-        api_key = os.environ.get("OPENAI_API_KEY")
+@st.cache_resource
+def _openai_client(api_key: str, base_url: str, timeout: float, max_retries: int) -> Any:
+    # один клиент (и его пул HTTP-соединений) на процесс для каждой конфигурации;
+    # клиент OpenAI потокобезопасен, его можно делить между сессиями
+    return OpenAI(api_key=api_key, base_url=base_url or None, timeout=timeout, max_retries=max_retries)
 
-    if not api_key:
-        return None
-    return OpenAI(api_key=api_key)
+
+def openai_limits() -> Tuple[float, int]:
+    """(timeout, max_retries) из OPENAI_TIMEOUT / OPENAI_MAX_RETRIES."""
+    try:
+        return float(get_setting("OPENAI_TIMEOUT", "120")), int(get_setting("OPENAI_MAX_RETRIES", "2"))
+    except ValueError:
+        return 120.0, 2
 
 
 def get_openai_model() -> str:
-    try:
-        m = st.secrets.get("OPENAI_MODEL", "")
-        if m:
-            return str(m)
-    except Exception:
-        pass
-    return os.environ.get("OPENAI_MODEL", "gpt-5.1")
+    return get_setting("OPENAI_MODEL", "gpt-5.1")
 
 
 # ============================
 # Общие структуры вопросов
 # ============================
 
-@dataclass
+# Вектор баллов: фиксированная длина, индекс = позиция потенциала в POTENTIALS
+ScoreVector = Tuple[float, ...]
+
+POT_INDEX = {p: i for i, p in enumerate(POTENTIALS)}
+ZERO_VECTOR: ScoreVector = (0.0,) * len(POTENTIALS)
+
+
+def score_vector(changes: Mapping[str, float]) -> ScoreVector:
+    vec = [0.0] * len(POTENTIALS)
+    for k, v in changes.items():
+        vec[POT_INDEX[k]] += float(v)
+    return tuple(vec)
+
+
+def vector_to_dict(vec: Any) -> Dict[str, float]:
+    return {p: float(vec[i]) for i, p in enumerate(POTENTIALS)}
+
+
+def option_id(qid: str, pos: int) -> str:
+    return f"{qid}:{pos}"
+
+
+@dataclass(frozen=True, slots=True)
 class AnswerOption:
     text: str
-    score_changes: Dict[str, float] = field(default_factory=dict)
-    inject_questions: List[str] = field(default_factory=list)
-    tags: List[str] = field(default_factory=list)  # для углубления
+    # в банках вопросов пишется словарём {pot: delta}, хранится как ScoreVector
+    score_changes: ScoreVector = ZERO_VECTOR
+    inject_questions: Tuple[str, ...] = ()
+    tags: Tuple[str, ...] = ()  # для углубления
+    id: str = ""  # проставляет Question: "<qid>:<позиция>"
 
+    def __post_init__(self):
+        if isinstance(self.score_changes, Mapping):
+            object.__setattr__(self, "score_changes", score_vector(self.score_changes))
+        object.__setattr__(self, "inject_questions", tuple(self.inject_questions))
+        object.__setattr__(self, "tags", tuple(self.tags))
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class Question:
     id: str
     text: str
@@ -171,7 +937,18 @@ class Question:
     group: str = ""            # для блока 3: c1/c2/c3
     allow_multiple: bool = False
     allow_comment: bool = True
-    options: List[AnswerOption] = field(default_factory=list)
+    options: Tuple[AnswerOption, ...] = ()
+    option_index: Mapping[str, int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # id варианта = позиция в вопросе: новые варианты добавляем в конец,
+        # иначе сохранённые selected_ids начнут указывать на другие варианты
+        options = tuple(o if o.id else replace(o, id=option_id(self.id, i)) for i, o in enumerate(self.options))
+        object.__setattr__(self, "options", options)
+        object.__setattr__(self, "option_index", MappingProxyType({o.id: i for i, o in enumerate(options)}))
+
+    def option_text(self, oid: str) -> str:
+        return self.options[self.option_index[oid]].text
 
 
 # ============================
@@ -221,9 +998,28 @@ LACK_TO_HINT = {
 }
 
 
-def apply_score(scores: Dict[str, float], changes: Dict[str, float]) -> None:
-    for k, v in changes.items():
-        scores[k] = float(scores.get(k, 0.0)) + float(v)
+MOTIVE_VEC = {k: score_vector(v) for k, v in MOTIVE_TO_POT.items()}
+LACK_VEC = {k: score_vector(v) for k, v in LACK_TO_HINT.items()}
+
+
+def apply_score(scores: List[float], changes: ScoreVector) -> None:
+    for i, v in enumerate(changes):
+        if v:
+            scores[i] += v
+
+
+def deep_vectors(deep: Optional[Dict[str, Any]]) -> List[ScoreVector]:
+    """Векторы мотива/дефицита из углубления (мягкий вклад)."""
+    if not deep:
+        return []
+    out = []
+    m = deep.get("motive")
+    l = deep.get("lack")
+    if m in MOTIVE_VEC:
+        out.append(MOTIVE_VEC[m])
+    if l in LACK_VEC:
+        out.append(LACK_VEC[l])
+    return out
 
 
 def render_deep_probe(qid: str, group_for_block3: Optional[str] = None) -> Dict[str, Any]:
@@ -985,206 +1781,730 @@ def build_block3_questions() -> List[Question]:
 
 
 # ============================
-# Движок прохождения (1 вопрос = 1 экран)
+# Реестр вопросов (один на процесс)
 # ============================
 
-def init_state():
-    if "initialized" in st.session_state:
-        return
+@dataclass(frozen=True)
+class QuestionBank:
+    b1: Mapping[str, Question]
+    b2: Tuple[Question, ...]
+    b3: Tuple[Question, ...]
+    by_id: Mapping[str, Question]
+    # граф ветвлений блока 1: qid → для каждого варианта кортеж добавляемых вопросов
+    b1_injections: Mapping[str, Tuple[Tuple[str, ...], ...]]
+
+
+def build_b1_injections(b1: Mapping[str, Question]) -> Dict[str, Tuple[Tuple[str, ...], ...]]:
+    graph = {}
+    for qid, q in b1.items():
+        for o in q.options:
+            unknown = [x for x in o.inject_questions if x not in b1]
+            if unknown:
+                raise ValueError(f"{o.id}: inject_questions ссылается на несуществующие вопросы {unknown}")
+        graph[qid] = tuple(o.inject_questions for o in q.options)
+    return graph
+
+
+def build_question_bank() -> QuestionBank:
+    b1 = build_block1_questions()
+    b2 = tuple(build_block2_questions())
+    b3 = tuple(build_block3_questions())
+    by_id = dict(b1)
+    by_id.update({q.id: q for q in b2 + b3})
+    return QuestionBank(b1=MappingProxyType(b1), b2=b2, b3=b3, by_id=MappingProxyType(by_id),
+                        b1_injections=MappingProxyType(build_b1_injections(b1)))
+
+
+@st.cache_resource
+def get_question_bank() -> QuestionBank:
+    """
+    Вопросы не меняются между клиентами: строим один раз на процесс,
+    а в st.session_state держим только ответы и курсоры (id / индексы).
+    """
+    return build_question_bank()
 
-    st.session_state.initialized = True
 
-    st.session_state.mode = "client"  # client/master
+# ============================
+# Движок прохождения (1 вопрос = 1 экран)
+# ============================
 
-    # client profile
-    st.session_state.client_name = ""
-    st.session_state.client_contact = ""
+def initial_session_state() -> Dict[str, Any]:
+    return {
+        "initialized": True,
+        "mode": "client",  # client/master
+        # client profile
+        "client_name": "",
+        "client_contact": "",
+        # id сессии = имя журнала событий = id записи в хранилище; задаётся на старте анкеты
+        "session_id": None,
+        "started_at": None,
+        # block1
+        "b1_scores": [0.0] * len(POTENTIALS),
+        "b1_answers": {},
+        "b1_core_index": 0,
+        "b1_injected_queue": deque(),
+        # всё, что уже запланировано/показано/отвечено: очередь и ядро не повторяют вопрос
+        "b1_seen": {CORE_SEQUENCE_BLOCK1[0]},
+        "b1_current_qid": CORE_SEQUENCE_BLOCK1[0],
+        "b1_done": False,
+        # block2
+        "b2_scores": [0.0] * len(POTENTIALS),
+        "b2_answers": {},
+        "b2_index": 0,
+        "b2_done": False,
+        # block3
+        "b3_scores_total": [0.0] * len(POTENTIALS),
+        "b3_scores_cols": {c: [0.0] * len(POTENTIALS) for c in ("c1", "c2", "c3")},
+        "b3_answers": {},
+        "b3_index": 0,
+        "b3_done": False,
+        # progress
+        "current_block": 0,  # 0=welcome,1,2,3,4=finish
+    }
 
-    # block1
-    st.session_state.b1_questions = build_block1_questions()
-    st.session_state.b1_scores = {p: 0.0 for p in POTENTIALS}
-    st.session_state.b1_answers: Dict[str, Any] = {}
-    st.session_state.b1_core_index = 0
-    st.session_state.b1_injected_queue: List[str] = []
-    st.session_state.b1_current_qid = CORE_SEQUENCE_BLOCK1[0]
-    st.session_state.b1_done = False
 
-    # block2
-    st.session_state.b2_questions = build_block2_questions()
-    st.session_state.b2_scores = {p: 0.0 for p in POTENTIALS}
-    st.session_state.b2_answers: Dict[str, Any] = {}
-    st.session_state.b2_index = 0
-    st.session_state.b2_done = False
+def init_state():
+    if "initialized" in st.session_state:
+        return
+    for k, v in initial_session_state().items():
+        st.session_state[k] = v
 
-    # block3
-    st.session_state.b3_questions = build_block3_questions()
-    st.session_state.b3_scores_total = {p: 0.0 for p in POTENTIALS}
-    st.session_state.b3_scores_cols = {p: {"c1": 0.0, "c2": 0.0, "c3": 0.0} for p in POTENTIALS}
-    st.session_state.b3_answers: Dict[str, Any] = {}
-    st.session_state.b3_index = 0
-    st.session_state.b3_done = False
 
-    # progress
-    st.session_state.current_block = 0  # 0=welcome,1,2,3,4=finish
+def schedule_b1_injections(state: Any, qids: Tuple[str, ...]) -> None:
+    seen = state["b1_seen"]
+    for qid in qids:
+        if qid not in seen:
+            seen.add(qid)
+            state["b1_injected_queue"].append(qid)
 
 
-def get_next_b1_question_id() -> Optional[str]:
+def get_next_b1_question_id(state: Any) -> Optional[str]:
     # injected first
-    while st.session_state.b1_injected_queue:
-        nxt = st.session_state.b1_injected_queue.pop(0)
-        if nxt not in st.session_state.b1_answers:
+    queue = state["b1_injected_queue"]
+    while queue:
+        nxt = queue.popleft()
+        if nxt not in state["b1_answers"]:
             return nxt
 
     # then core
+    seen = state["b1_seen"]
     while True:
-        st.session_state.b1_core_index += 1
-        if st.session_state.b1_core_index >= len(CORE_SEQUENCE_BLOCK1):
+        state["b1_core_index"] += 1
+        if state["b1_core_index"] >= len(CORE_SEQUENCE_BLOCK1):
             return None
-        cand = CORE_SEQUENCE_BLOCK1[st.session_state.b1_core_index]
-        if cand not in st.session_state.b1_answers:
+        cand = CORE_SEQUENCE_BLOCK1[state["b1_core_index"]]
+        if cand not in seen:
+            seen.add(cand)
             return cand
 
 
-def apply_b1_answer(question: Question, selected_indices: List[int], comment: str, deep: Optional[Dict[str, Any]]):
-    # save
-    selected_texts = [question.options[i].text for i in selected_indices]
-    st.session_state.b1_answers[question.id] = {
+def b1_remaining_count(state: Any) -> int:
+    """Сколько вопросов блока 1 ещё впереди (не считая текущего) при уже данных ответах."""
+    seen = state["b1_seen"]
+    core_left = sum(1 for qid in CORE_SEQUENCE_BLOCK1[state["b1_core_index"] + 1:] if qid not in seen)
+    return len(state["b1_injected_queue"]) + core_left
+
+
+def selected_payload(question: Question, selected_indices: List[int]) -> Dict[str, List[str]]:
+    """Выбор сохраняем и текстами (для чтения), и id вариантов (для пересчёта/аналитики)."""
+    return {
+        "selected": [question.options[i].text for i in selected_indices],
+        "selected_ids": [question.options[i].id for i in selected_indices],
+    }
+
+
+def apply_b1_answer(state: Any, question: Question, selected_indices: List[int], comment: str,
+                    deep: Optional[Dict[str, Any]], record: bool = True):
+    if record:
+        record_answer_event(state, 1, question, selected_indices, comment, deep)
+    selected = selected_payload(question, selected_indices)
+    state["b1_answers"][question.id] = {
         "question": question.text,
-        "selected": selected_texts,
+        **selected,
         "comment": (comment or "").strip(),
         "deep": deep or None,
     }
 
     # score + inject
+    injections = get_question_bank().b1_injections[question.id]
     for idx in selected_indices:
-        opt = question.options[idx]
-        apply_score(st.session_state.b1_scores, opt.score_changes)
-        for qid in opt.inject_questions:
-            if qid not in st.session_state.b1_answers and qid not in st.session_state.b1_injected_queue:
-                st.session_state.b1_injected_queue.append(qid)
+        apply_score(state["b1_scores"], question.options[idx].score_changes)
+        schedule_b1_injections(state, injections[idx])
 
     # deep probe scoring (мягко)
-    if deep:
-        m = deep.get("motive")
-        l = deep.get("lack")
-        if m in MOTIVE_TO_POT:
-            apply_score(st.session_state.b1_scores, MOTIVE_TO_POT[m])
-        if l in LACK_TO_HINT:
-            apply_score(st.session_state.b1_scores, LACK_TO_HINT[l])
-
-    nxt = get_next_b1_question_id()
-    st.session_state.b1_current_qid = nxt
+    for vec in deep_vectors(deep):
+        apply_score(state["b1_scores"], vec)
+
+    nxt = get_next_b1_question_id(state)
+    state["b1_current_qid"] = nxt
     if nxt is None:
-        st.session_state.b1_done = True
+        state["b1_done"] = True
 
 
-def apply_b2_answer(question: Question, selected_indices: List[int], comment: str, deep: Optional[Dict[str, Any]]):
-    selected_texts = [question.options[i].text for i in selected_indices]
-    st.session_state.b2_answers[question.id] = {
+def apply_b2_answer(state: Any, question: Question, selected_indices: List[int], comment: str,
+                    deep: Optional[Dict[str, Any]], record: bool = True):
+    if record:
+        record_answer_event(state, 2, question, selected_indices, comment, deep)
+    selected = selected_payload(question, selected_indices)
+    state["b2_answers"][question.id] = {
         "question": question.text,
-        "selected": selected_texts,
+        **selected,
         "comment": (comment or "").strip(),
         "deep": deep or None,
     }
 
     for idx in selected_indices:
         opt = question.options[idx]
-        apply_score(st.session_state.b2_scores, opt.score_changes)
+        apply_score(state["b2_scores"], opt.score_changes)
 
-    if deep:
-        m = deep.get("motive")
-        l = deep.get("lack")
-        if m in MOTIVE_TO_POT:
-            apply_score(st.session_state.b2_scores, MOTIVE_TO_POT[m])
-        if l in LACK_TO_HINT:
-            apply_score(st.session_state.b2_scores, LACK_TO_HINT[l])
+    for vec in deep_vectors(deep):
+        apply_score(state["b2_scores"], vec)
 
-    st.session_state.b2_index += 1
-    if st.session_state.b2_index >= len(st.session_state.b2_questions):
-        st.session_state.b2_done = True
+    state["b2_index"] += 1
+    if state["b2_index"] >= len(get_question_bank().b2):
+        state["b2_done"] = True
 
 
-def apply_b3_answer(question: Question, selected_indices: List[int], comment: str, deep: Dict[str, Any]):
-    selected_texts = [question.options[i].text for i in selected_indices]
-    st.session_state.b3_answers[question.id] = {
+def apply_b3_answer(state: Any, question: Question, selected_indices: List[int], comment: str,
+                    deep: Dict[str, Any], record: bool = True):
+    if record:
+        record_answer_event(state, 3, question, selected_indices, comment, deep)
+    selected = selected_payload(question, selected_indices)
+    state["b3_answers"][question.id] = {
         "question": question.text,
-        "selected": selected_texts,
+        **selected,
         "comment": (comment or "").strip(),
         "deep": deep or None,
         "group": question.group,
     }
 
-    # base score per selected option
-    for idx in selected_indices:
-        opt = question.options[idx]
-        apply_score(st.session_state.b3_scores_total, opt.score_changes)
-        for pot, delta in opt.score_changes.items():
-            if pot in st.session_state.b3_scores_cols:
-                st.session_state.b3_scores_cols[pot][question.group] += float(delta)
-
-    # deep probe: apply within same column too
-    if deep:
-        m = deep.get("motive")
-        l = deep.get("lack")
-        if m in MOTIVE_TO_POT:
-            apply_score(st.session_state.b3_scores_total, MOTIVE_TO_POT[m])
-            for pot, delta in MOTIVE_TO_POT[m].items():
-                if pot in st.session_state.b3_scores_cols:
-                    st.session_state.b3_scores_cols[pot][question.group] += float(delta)
-        if l in LACK_TO_HINT:
-            apply_score(st.session_state.b3_scores_total, LACK_TO_HINT[l])
-            for pot, delta in LACK_TO_HINT[l].items():
-                if pot in st.session_state.b3_scores_cols:
-                    st.session_state.b3_scores_cols[pot][question.group] += float(delta)
-
-    st.session_state.b3_index += 1
-    if st.session_state.b3_index >= len(st.session_state.b3_questions):
-        st.session_state.b3_done = True
-
-
-def combined_total_scores() -> Dict[str, float]:
-    out = {p: 0.0 for p in POTENTIALS}
-    for p in POTENTIALS:
-        out[p] += float(st.session_state.b1_scores.get(p, 0.0))
-        out[p] += float(st.session_state.b2_scores.get(p, 0.0))
-        out[p] += float(st.session_state.b3_scores_total.get(p, 0.0))
+    # base score per selected option + deep probe: в total и в тот же столбец
+    col = state["b3_scores_cols"][question.group]
+    vectors = [question.options[idx].score_changes for idx in selected_indices] + deep_vectors(deep)
+    for vec in vectors:
+        apply_score(state["b3_scores_total"], vec)
+        apply_score(col, vec)
+
+    state["b3_index"] += 1
+    if state["b3_index"] >= len(get_question_bank().b3):
+        state["b3_done"] = True
+
+
+def combined_total_scores(state: Any) -> Dict[str, float]:
+    b1 = state["b1_scores"]
+    b2 = state["b2_scores"]
+    b3 = state["b3_scores_total"]
+    return vector_to_dict([b1[i] + b2[i] + b3[i] for i in range(len(POTENTIALS))])
+
+
+def block3_cols_to_dict(cols: Mapping[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    """{c1: вектор, ...} → формат хранения {pot: {c1, c2, c3}}."""
+    return {p: {c: float(vec[i]) for c, vec in cols.items()} for i, p in enumerate(POTENTIALS)}
+
+
+def build_result_payload(state: Any) -> Dict[str, Any]:
+    """Запись для хранилища результатов; id = id сессии (он же в журнале событий и в ссылке)."""
+    return {
+        "id": state["session_id"] or str(uuid.uuid4()),
+        "created_at": _now_iso(),
+        "started_at": state["started_at"],
+        "client_name": state["client_name"].strip(),
+        "client_contact": state["client_contact"].strip(),
+        "answers": {
+            "block1": state["b1_answers"],
+            "block2": state["b2_answers"],
+            "block3": state["b3_answers"],
+        },
+        "scores": {
+            "block1": vector_to_dict(state["b1_scores"]),
+            "block2": vector_to_dict(state["b2_scores"]),
+            "block3_total": vector_to_dict(state["b3_scores_total"]),
+            "block3_cols": block3_cols_to_dict(state["b3_scores_cols"]),
+            "combined_total": combined_total_scores(state),
+        },
+        "master_report": {
+            "generated_at": None,
+            "draft_text": "",
+            "rows_override": None,
+        },
+    }
+
+
+# ============================
+# Автосохранение: журнал событий сессии
+# ============================
+
+SESSION_EVENTS_DIR = "deep_identity_events"
+SESSION_ID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+class SessionEventLog:
+    """
+    <SESSION_EVENTS_DIR>/<session_id>.jsonl: одна строка на событие (start / answer).
+    Дописывается на каждый ответ — дёшево и без перезаписи; состояние сессии
+    восстанавливается проигрыванием журнала (replay_session_events).
+    """
+
+    def __init__(self, session_id: str, path: str = SESSION_EVENTS_DIR):
+        if not SESSION_ID_RE.fullmatch(session_id):
+            raise ValueError(f"bad session id: {session_id!r}")
+        self.session_id = session_id
+        self.file = os.path.join(path, f"{session_id}.jsonl")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.file)
+
+    def append(self, event: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        line = json.dumps({**event, "at": _now_iso()}, ensure_ascii=False) + "\n"
+        with open(self.file, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self) -> List[Dict[str, Any]]:
+        events = []
+        try:
+            with open(self.file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # оборванная последняя строка (падение посреди записи)
+                        continue
+        except FileNotFoundError:
+            pass
+        return events
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.file)
+        except FileNotFoundError:
+            pass
+
+
+def start_session(state: Any) -> None:
+    """Новый id сессии + событие start (имя/контакт) в журнал."""
+    state["session_id"] = str(uuid.uuid4())
+    state["started_at"] = _now_iso()
+    SessionEventLog(state["session_id"]).append({
+        "type": "start", "client_name": state["client_name"], "client_contact": state["client_contact"],
+        "started_at": state["started_at"]})
+
+
+def record_answer_event(state: Any, block: int, question: Question, selected_indices: List[int],
+                        comment: str, deep: Optional[Dict[str, Any]]) -> None:
+    if not state.get("session_id"):
+        return
+    SessionEventLog(state["session_id"]).append({
+        "type": "answer", "block": block, "qid": question.id,
+        "selected_ids": [question.options[i].id for i in selected_indices],
+        "comment": comment or "", "deep": deep or None})
+
+
+APPLY_ANSWER = {1: apply_b1_answer, 2: apply_b2_answer, 3: apply_b3_answer}
+
+
+def replay_session_events(session_id: str, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Состояние анкеты из журнала: те же apply_b*_answer, что и вживую, только без записи."""
+    state = initial_session_state()
+    state["session_id"] = session_id
+    bank = get_question_bank()
+    for ev in events:
+        if ev.get("type") == "start":
+            state["client_name"] = ev.get("client_name") or ""
+            state["client_contact"] = ev.get("client_contact") or ""
+            state["started_at"] = ev.get("started_at") or ev.get("at")
+            state["current_block"] = 1
+        elif ev.get("type") == "answer":
+            q = bank.by_id.get(ev.get("qid", ""))
+            if q is None:
+                continue
+            indices = [q.option_index[oid] for oid in ev.get("selected_ids") or [] if oid in q.option_index]
+            APPLY_ANSWER[q.block](state, q, indices, ev.get("comment") or "", ev.get("deep"), record=False)
+    # блок, на котором остановились (render_block* сами перейдут дальше, если блок закрыт)
+    if state["current_block"]:
+        state["current_block"] = 4 if state["b3_done"] else 3 if state["b2_done"] else 2 if state["b1_done"] else 1
+    return state
+
+
+def resume_session_from_link() -> None:
+    """?sid=<id> в адресе: продолжить анкету с последнего сохранённого ответа."""
+    sid = st.query_params.get("sid")
+    if not sid or st.session_state.get("session_id") == sid or not SESSION_ID_RE.fullmatch(sid):
+        return
+    log = SessionEventLog(sid)
+    if log.exists():
+        for k, v in replay_session_events(sid, log.read()).items():
+            st.session_state[k] = v
+    elif get_result(sid) is not None:
+        st.session_state.resume_notice = "Эта диагностика уже завершена и сохранена. Можно пройти заново."
+        del st.query_params["sid"]
+
+
+def save_finished_session(state: Any) -> Dict[str, Any]:
+    """Сжатие: законченная сессия уходит в хранилище результатов, её журнал удаляется."""
+    payload = build_result_payload(state)
+    # append идемпотентен по id во всех хранилищах — без предварительного поиска по истории
+    append_result(payload)
+    if state.get("session_id"):
+        SessionEventLog(state["session_id"]).remove()
+    return payload
+
+
+def compact_session_events(path: str = SESSION_EVENTS_DIR) -> Dict[str, int]:
+    """
+    Для CLI: законченные, но не сохранённые сессии (упали между последним ответом
+    и финальным экраном) переносит в хранилище; журналы уже сохранённых удаляет.
+    Незаконченные не трогает — их ещё можно продолжить по ссылке.
+    """
+    stats = {"saved": 0, "removed": 0, "in_progress": 0}
+    if not os.path.isdir(path):
+        return stats
+    for name in sorted(os.listdir(path)):
+        sid = name[:-len(".jsonl")]
+        if not name.endswith(".jsonl") or not SESSION_ID_RE.fullmatch(sid):
+            continue
+        log = SessionEventLog(sid, path)
+        if get_result(sid) is not None:
+            log.remove()
+            stats["removed"] += 1
+            continue
+        state = replay_session_events(sid, log.read())
+        if state["b3_done"]:
+            save_finished_session(state)
+            stats["saved"] += 1
+        else:
+            stats["in_progress"] += 1
+    return stats
+
+
+# ============================
+# Скоринг-движок (матрица весов)
+# ============================
+
+# Слоты баллов сессии. block3_total копит те же строки, что c1/c2/c3,
+# в порядке ответов — ровно как apply_b3_answer, без расхождений во float.
+SCORE_SLOTS = ("block1", "block2", "block3_total", "c1", "c2", "c3")
+_SLOT_INDEX = {s: i for i, s in enumerate(SCORE_SLOTS)}
+
+
+@dataclass(frozen=True)
+class ScoringEngine:
+    """
+    weights: (R, 9) — строки = варианты ответов всех блоков + мотивы + дефициты,
+    столбцы = POTENTIALS. Баллы сессии = разреженный выбор строк × weights.
+    """
+    weights: np.ndarray
+    option_rows: Mapping[str, Tuple[int, ...]]            # qid → строка для каждого варианта
+    option_by_text: Mapping[str, Mapping[str, int]]       # qid → текст варианта → индекс
+    option_row_by_id: Mapping[str, int]                   # id варианта → строка
+    question_slots: Mapping[str, Tuple[int, ...]]         # qid → слоты, куда идут баллы
+    motive_rows: Mapping[str, int]
+    lack_rows: Mapping[str, int]
+
+    def selection(self, answers: Mapping[str, Any]) -> List[Tuple[int, int]]:
+        """
+        Сохранённые answers ({"block1": {qid: {...}}, ...}) → пары (слот, строка).
+        Варианты ищутся по selected_ids, у старых записей — по тексту;
+        неизвестные вопросы/варианты пропускаются.
+        """
+        out: List[Tuple[int, int]] = []
+        for block_key in ("block1", "block2", "block3"):
+            for qid, a in (answers.get(block_key) or {}).items():
+                slots = self.question_slots.get(qid)
+                if not slots:
+                    continue
+                if "selected_ids" in a:
+                    by_id = self.option_row_by_id
+                    picked = [by_id[oid] for oid in a["selected_ids"] if oid in by_id]
+                else:
+                    rows = self.option_rows[qid]
+                    by_text = self.option_by_text[qid]
+                    picked = [rows[by_text[t]] for t in (a.get("selected") or []) if t in by_text]
+                deep = a.get("deep") or None
+                if deep:
+                    if deep.get("motive") in self.motive_rows:
+                        picked.append(self.motive_rows[deep["motive"]])
+                    if deep.get("lack") in self.lack_rows:
+                        picked.append(self.lack_rows[deep["lack"]])
+                out.extend((slot, row) for row in picked for slot in slots)
+        return out
+
+    def score_batch(self, selections: List[List[Tuple[int, int]]]) -> np.ndarray:
+        """(N, len(SCORE_SLOTS), 9): один np.add.at на всю пачку сессий."""
+        out = np.zeros((len(selections), len(SCORE_SLOTS), len(POTENTIALS)))
+        sizes = [len(sel) for sel in selections]
+        if not any(sizes):
+            return out
+        sess = np.repeat(np.arange(len(selections), dtype=np.intp), sizes)
+        flat = itertools.chain.from_iterable(itertools.chain.from_iterable(selections))
+        slot_rows = np.fromiter(flat, dtype=np.intp, count=2 * len(sess)).reshape(-1, 2)
+        np.add.at(out, (sess, slot_rows[:, 0]), self.weights[slot_rows[:, 1]])
+        return out
+
+
+def build_scoring_engine(bank: QuestionBank) -> ScoringEngine:
+    rows: List[ScoreVector] = []
+    option_rows: Dict[str, Tuple[int, ...]] = {}
+    option_by_text: Dict[str, Dict[str, int]] = {}
+    option_row_by_id: Dict[str, int] = {}
+    question_slots: Dict[str, Tuple[int, ...]] = {}
+
+    for q in list(bank.b1.values()) + list(bank.b2) + list(bank.b3):
+        option_rows[q.id] = tuple(range(len(rows), len(rows) + len(q.options)))
+        rows.extend(o.score_changes for o in q.options)
+        by_text: Dict[str, int] = {}
+        for i, o in enumerate(q.options):
+            by_text.setdefault(o.text, i)
+        option_by_text[q.id] = MappingProxyType(by_text)
+        option_row_by_id.update({o.id: row for o, row in zip(q.options, option_rows[q.id])})
+        if q.block == 3:
+            question_slots[q.id] = (_SLOT_INDEX["block3_total"], _SLOT_INDEX[q.group])
+        else:
+            question_slots[q.id] = (_SLOT_INDEX[f"block{q.block}"],)
+
+    motive_rows = {}
+    for k, vec in MOTIVE_VEC.items():
+        motive_rows[k] = len(rows)
+        rows.append(vec)
+    lack_rows = {}
+    for k, vec in LACK_VEC.items():
+        lack_rows[k] = len(rows)
+        rows.append(vec)
+
+    weights = np.array(rows, dtype=np.float64)
+    weights.setflags(write=False)
+    return ScoringEngine(
+        weights=weights,
+        option_rows=MappingProxyType(option_rows),
+        option_by_text=MappingProxyType(option_by_text),
+        option_row_by_id=MappingProxyType(option_row_by_id),
+        question_slots=MappingProxyType(question_slots),
+        motive_rows=MappingProxyType(motive_rows),
+        lack_rows=MappingProxyType(lack_rows),
+    )
+
+
+@st.cache_resource
+def get_scoring_engine() -> ScoringEngine:
+    return build_scoring_engine(get_question_bank())
+
+
+def scores_from_tensor(t: np.ndarray) -> Dict[str, Any]:
+    """Срез (len(SCORE_SLOTS), 9) одной сессии → формат session["scores"]."""
+    b1 = t[_SLOT_INDEX["block1"]]
+    b2 = t[_SLOT_INDEX["block2"]]
+    b3 = t[_SLOT_INDEX["block3_total"]]
+    cols = {c: t[_SLOT_INDEX[c]] for c in ("c1", "c2", "c3")}
+    return {
+        "block1": vector_to_dict(b1),
+        "block2": vector_to_dict(b2),
+        "block3_total": vector_to_dict(b3),
+        "block3_cols": block3_cols_to_dict(cols),
+        "combined_total": vector_to_dict(b1 + b2 + b3),
+    }
+
+
+def rescore_sessions(sessions: List[Dict[str, Any]], engine: Optional[ScoringEngine] = None) -> List[Dict[str, Any]]:
+    """Пересчёт session["scores"] по сохранённым answers для пачки сессий сразу."""
+    engine = engine or get_scoring_engine()
+    tensor = engine.score_batch([engine.selection(x.get("answers") or {}) for x in sessions])
+    return [scores_from_tensor(t) for t in tensor]
+
+
+# ============================
+# Таблица 3×3: совместное назначение (венгерский алгоритм)
+# ============================
+
+TABLE_COLS = ("c1", "c2", "c3")
+# вес ранга (суммы баллов) против баллов столбцов, когда ряды не заданы
+TABLE_ROW_WEIGHT = 1.0
+# сколько вариантов таблицы показывать мастеру для сравнения
+TABLE_ALTERNATIVES = 5
+# запрещённая клетка: настолько невыгодна, что решатель берёт её, только если иначе нельзя
+_FORBIDDEN = -1e9
+# при точном равенстве сумм предпочитается исходный порядок потенциалов в ряду;
+# «равенство с шумом float» решатель может разрешить иначе, чем batch_tables (argmax перестановок),
+# поэтому текущую таблицу среди альтернатив узнаём и по оценке (current_option_index)
+_TIE_EPS = 1e-7
+
+
+@dataclass(frozen=True)
+class TableOption:
+    table: Tuple[Tuple[str, ...], ...]   # 3 ряда × 3 столбца, ключи потенциалов
+    score: float                         # сумма полезностей клеток
+
+    def rows(self) -> List[List[str]]:
+        return [list(r) for r in self.table]
+
+
+def column_matrix(col_scores: Mapping[str, Mapping[str, float]]) -> np.ndarray:
+    """(9, 3): баллы блока 3 по столбцам в порядке POTENTIALS."""
+    m = np.zeros((len(POTENTIALS), len(TABLE_COLS)))
+    for pot, cols in col_scores.items():
+        if pot in POT_INDEX:
+            m[POT_INDEX[pot]] = [float(cols.get(c, 0.0)) for c in TABLE_COLS]
+    return m
+
+
+def cell_utility(cols: np.ndarray, combined: Optional[Mapping[str, float]] = None,
+                 rows: Optional[List[List[str]]] = None, row_weight: float = TABLE_ROW_WEIGHT) -> np.ndarray:
+    """
+    (9 потенциалов, 9 клеток), клетка = ряд * 3 + столбец.
+    rows заданы — потенциал может стоять только в своём ряду (выбор мастера);
+    иначе к баллу столбца добавляется ранг: сильные тянутся в ряд 1, слабые — в ряд 3.
+    """
+    u = np.tile(cols, (1, 3))
+    if rows is not None:
+        allowed = np.full(u.shape, False)
+        for r, row in enumerate(rows):
+            for pos, pot in enumerate(row):
+                allowed[POT_INDEX[pot], r * 3:(r + 1) * 3] = True
+                u[POT_INDEX[pot], r * 3:(r + 1) * 3] -= _TIE_EPS * pos * np.array([9, 3, 1])
+        return np.where(allowed, u, _FORBIDDEN)
+    total = np.array([float((combined or {}).get(p, 0.0)) for p in POTENTIALS])
+    spread = float(total.max() - total.min()) or 1.0
+    z = (total - total.min()) / spread
+    scale = max(float(cols.max() - cols.min()), 1.0)
+    for r in range(3):
+        u[:, r * 3:(r + 1) * 3] += row_weight * scale * (1 - r) * z[:, None]
+    return u
+
+
+def hungarian_max(u: np.ndarray) -> Tuple[List[int], float]:
+    """Назначение строк столбцам с максимальной суммой (квадратная матрица), O(n³)."""
+    n = len(u)
+    cost = (-u).tolist()
+    inf = float("inf")
+    pu = [0.0] * (n + 1)
+    pv = [0.0] * (n + 1)
+    match = [0] * (n + 1)   # столбец → строка (с 1)
+    way = [0] * (n + 1)
+    for i in range(1, n + 1):
+        match[0] = i
+        j0 = 0
+        minv = [inf] * (n + 1)
+        used = [False] * (n + 1)
+        while True:
+            used[j0] = True
+            i0 = match[j0]
+            delta = inf
+            j1 = 0
+            row = cost[i0 - 1]
+            for j in range(1, n + 1):
+                if not used[j]:
+                    cur = row[j - 1] - pu[i0] - pv[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(n + 1):
+                if used[j]:
+                    pu[match[j]] += delta
+                    pv[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if match[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+    assign = [0] * n
+    for j in range(1, n + 1):
+        assign[match[j] - 1] = j - 1
+    return assign, -sum(cost[i][assign[i]] for i in range(n))
+
+
+def top_k_assignments(u: np.ndarray, k: int) -> List[Tuple[List[int], float]]:
+    """k лучших назначений по убыванию суммы (Murty: разбиение пространства решений)."""
+    def solve(m: np.ndarray) -> Optional[Tuple[List[int], float]]:
+        assign, score = hungarian_max(m)
+        return (assign, score) if score > _FORBIDDEN / 2 else None
+
+    first = solve(u)
+    if first is None:
+        return []
+    tie = itertools.count()
+    heap = [(-first[1], next(tie), first[0], u)]
+    out: List[Tuple[List[int], float]] = []
+    while heap and len(out) < k:
+        neg, _, assign, m = heapq.heappop(heap)
+        out.append((assign, -neg))
+        if len(out) == k:
+            break
+        fixed = m.copy()
+        for i in range(len(assign)):
+            sub = fixed.copy()
+            sub[i, assign[i]] = _FORBIDDEN
+            sol = solve(sub)
+            if sol is not None:
+                heapq.heappush(heap, (-sol[1], next(tie), sol[0], sub))
+            # дальше пара (i, assign[i]) закреплена
+            keep = fixed[i, assign[i]]
+            fixed[i, :] = _FORBIDDEN
+            fixed[:, assign[i]] = _FORBIDDEN
+            fixed[i, assign[i]] = keep
     return out
 
 
-def best_column_for_pot(pot: str, col_scores: Dict[str, Dict[str, float]]) -> str:
-    cols = col_scores.get(pot, {"c1": 0.0, "c2": 0.0, "c3": 0.0})
-    return max(cols.keys(), key=lambda c: cols[c])
+def solve_tables(col_scores: Mapping[str, Mapping[str, float]], combined: Optional[Mapping[str, float]] = None,
+                 rows: Optional[List[List[str]]] = None, k: int = 1) -> List[TableOption]:
+    """Лучшие k таблиц 3×3 с их оценкой; rows — фиксированный состав рядов."""
+    u = cell_utility(column_matrix(col_scores), combined, rows)
+    options = []
+    for assign, score in top_k_assignments(u, k):
+        grid = [[""] * 3 for _ in range(3)]
+        for p, cell in enumerate(assign):
+            grid[cell // 3][cell % 3] = POTENTIALS[p]
+        options.append(TableOption(tuple(tuple(r) for r in grid), round(score, 4)))
+    return options
+
+
+def table_score(col_scores: Mapping[str, Mapping[str, float]], combined: Optional[Mapping[str, float]],
+                rows: Optional[List[List[str]]], table: List[List[str]]) -> float:
+    """Оценка готовой таблицы в тех же полезностях, что у solve_tables (округление то же)."""
+    u = cell_utility(column_matrix(col_scores), combined, rows)
+    return round(sum(float(u[POT_INDEX[p], r * 3 + c]) for r, row in enumerate(table) for c, p in enumerate(row)), 4)
+
 
+def current_option_index(options: List[TableOption], table: List[List[str]], score: float) -> Optional[int]:
+    """Какой из вариантов — текущая таблица: совпадение по клеткам, иначе первый с той же оценкой."""
+    for i, opt in enumerate(options):
+        if opt.rows() == table:
+            return i
+    for i, opt in enumerate(options):
+        if opt.score == score:
+            return i
+    return None
 
-def assign_row_to_columns(row_pots: List[str], col_scores: Dict[str, Dict[str, float]]) -> Dict[str, str]:
+
+_ROW_PERMS = np.array(list(itertools.permutations(range(3))))
+
+
+def batch_tables(rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
     """
-    row_pots: 3 потенциала
-    Возвращает mapping: {"c1": pot, "c2": pot, "c3": pot}
-    Выбираем перестановку, максимизирующую сумму соответствующих колонок.
+    Пачка таблиц при заданных рядах (пересчёт всей истории):
+    rows (N, 3, 3) — индексы потенциалов по рядам, cols (N, 9, 3) — column_matrix сессий.
+    При фиксированных рядах совместный оптимум распадается на лучшую перестановку
+    каждого ряда, поэтому все 6 перестановок × 3 ряда × N считаются одним выражением.
+    → (N, 3, 3): индекс потенциала в клетке [ряд, столбец].
     """
-    cols = ["c1", "c2", "c3"]
-    best_map = None
-    best_sum = -1e9
-    for perm in itertools.permutations(row_pots, 3):
-        s = 0.0
-        for c, pot in zip(cols, perm):
-            s += float(col_scores.get(pot, {}).get(c, 0.0))
-        if s > best_sum:
-            best_sum = s
-            best_map = dict(zip(cols, perm))
-    return best_map or {"c1": row_pots[0], "c2": row_pots[1], "c3": row_pots[2]}
+    perm_pots = rows[:, :, _ROW_PERMS]                                   # (N, 3, 6, 3)
+    vals = cols[np.arange(len(rows))[:, None, None, None], perm_pots, np.arange(3)]
+    sums = vals[..., 0] + vals[..., 1] + vals[..., 2]                  # (N, 3, 6)
+    best = sums.argmax(axis=2)                                           # первая из равных, как у перебора
+    return np.take_along_axis(perm_pots, best[:, :, None, None], axis=2)[:, :, 0, :]
 
 
 def build_3x3_table(row1: List[str], row2: List[str], row3: List[str], col_scores: Dict[str, Dict[str, float]]) -> List[List[str]]:
-    m1 = assign_row_to_columns(row1, col_scores)
-    m2 = assign_row_to_columns(row2, col_scores)
-    m3 = assign_row_to_columns(row3, col_scores)
-    # rows: [c1,c2,c3]
-    return [
-        [m1["c1"], m1["c2"], m1["c3"]],
-        [m2["c1"], m2["c2"], m2["c3"]],
-        [m3["c1"], m3["c2"], m3["c3"]],
-    ]
+    rows = np.array([[[POT_INDEX[p] for p in r] for r in (row1, row2, row3)]])
+    table = batch_tables(rows, column_matrix(col_scores)[None])[0]
+    return [[POTENTIALS[i] for i in r] for r in table.tolist()]
 
 
 # ============================
@@ -1195,6 +2515,8 @@ def render_welcome():
     st.title("Deep Identity · Диагностика потенциалов")
     st.write("Ответь честно. Здесь нет правильных ответов — есть твоя природа.")
     st.info("⚠️ Отчёт видит только мастер. Клиент видит только вопросы и финальный экран «Спасибо».")
+    if st.session_state.get("resume_notice"):
+        st.success(st.session_state.pop("resume_notice"))
 
     st.markdown("### Как тебя зовут? (чтобы в отчёте было имя)")
     st.session_state.client_name = st.text_input("Имя", value=st.session_state.client_name, placeholder="Например: Нурлан")
@@ -1203,6 +2525,9 @@ def render_welcome():
     st.session_state.client_contact = st.text_input("Телеграм / email", value=st.session_state.client_contact, placeholder="@username или email")
 
     if st.button("Начать диагностику"):
+        start_session(st.session_state)
+        # ссылка с sid позволяет продолжить с того же места после обрыва/перезагрузки
+        st.query_params["sid"] = st.session_state.session_id
         st.session_state.current_block = 1
         st.rerun()
 
@@ -1216,16 +2541,21 @@ def render_question_screen(question: Question, total_progress: Tuple[int, int],
 
     st.markdown(f"### {question.text}")
 
-    labels = [o.text for o in question.options]
+    # виджеты возвращают id вариантов, индекс — через готовый option_index
+    oids = list(question.option_index)
+    index = question.option_index
 
     selected_indices: List[int] = []
     if question.allow_multiple:
-        chosen = st.multiselect("Выбери один или несколько вариантов:", options=labels, key=f"sel_{question.id}")
-        selected_indices = [labels.index(x) for x in chosen] if chosen else []
+        chosen = st.multiselect("Выбери один или несколько вариантов:", options=oids,
+                                format_func=question.option_text, key=f"sel_{question.id}")
+        selected_indices = [index[x] for x in chosen] if chosen else []
     else:
-        chosen = st.radio("Выбери один вариант:", options=["— не выбрано —"] + labels, key=f"sel_{question.id}")
-        if chosen != "— не выбрано —":
-            selected_indices = [labels.index(chosen)]
+        chosen = st.radio("Выбери один вариант:", options=[None] + oids,
+                          format_func=lambda x: "— не выбрано —" if x is None else question.option_text(x),
+                          key=f"sel_{question.id}")
+        if chosen is not None:
+            selected_indices = [index[chosen]]
 
     comment = ""
     if question.allow_comment:
@@ -1242,13 +2572,13 @@ def render_question_screen(question: Question, total_progress: Tuple[int, int],
     with col1:
         if st.button("Дальше ➜", disabled=not can_next, key=f"next_{question.id}"):
             if question.block == 1:
-                apply_b1_answer(question, selected_indices, comment, deep)
+                apply_b1_answer(st.session_state, question, selected_indices, comment, deep)
                 st.rerun()
             elif question.block == 2:
-                apply_b2_answer(question, selected_indices, comment, deep)
+                apply_b2_answer(st.session_state, question, selected_indices, comment, deep)
                 st.rerun()
             else:
-                apply_b3_answer(question, selected_indices, comment, deep)
+                apply_b3_answer(st.session_state, question, selected_indices, comment, deep)
                 st.rerun()
     with col2:
         st.caption("Если не хочешь выбирать вариант — напиши хотя бы 1–2 строки комментария. Это тоже сигнал.")
@@ -1260,13 +2590,12 @@ def render_block1():
         st.session_state.current_block = 2
         st.rerun()
 
-    q = st.session_state.b1_questions[qid]
-    # прогресс (оценка)
+    q = get_question_bank().b1[qid]
+    # прогресс: отвечено / отвечено + текущий + уже запланированные
     answered = len(st.session_state.b1_answers)
-    approx_total = len(CORE_SEQUENCE_BLOCK1) + 6
     render_question_screen(
         q,
-        total_progress=(answered, approx_total),
+        total_progress=(answered, answered + 1 + b1_remaining_count(st.session_state)),
         block_title="Блок 1 · Детство и естественные склонности",
         group_caption="Мы ищем чистую мотивацию до социальных масок."
     )
@@ -1278,7 +2607,7 @@ def render_block2():
         st.rerun()
 
     idx = st.session_state.b2_index
-    q_list = st.session_state.b2_questions
+    q_list = get_question_bank().b2
     q = q_list[idx]
     render_question_screen(
         q,
@@ -1294,7 +2623,7 @@ def render_block3():
         st.rerun()
 
     idx = st.session_state.b3_index
-    q_list = st.session_state.b3_questions
+    q_list = get_question_bank().b3
     q = q_list[idx]
 
     col_name = {"c1": "Столбец 1 · Восприятие (ВАУ)",
@@ -1313,42 +2642,17 @@ def render_finish_and_save():
     st.title("Спасибо! Диагностика завершена ✅")
     st.write("Твои ответы сохранены. Мастер сформирует отчёт отдельно.")
 
-    total = combined_total_scores()
+    total = combined_total_scores(st.session_state)
     top = sorted(total.items(), key=lambda x: x[1], reverse=True)
 
     st.markdown("### Топ-сигналы (черновые, без интерпретации)")
     for k, v in top[:5]:
         st.write(f"- **{POT_LABEL[k]}**: {round(v, 2)}")
 
-    # save
-    payload = {
-        "id": str(uuid.uuid4()),
-        "created_at": _now_iso(),
-        "client_name": st.session_state.client_name.strip(),
-        "client_contact": st.session_state.client_contact.strip(),
-        "answers": {
-            "block1": st.session_state.b1_answers,
-            "block2": st.session_state.b2_answers,
-            "block3": st.session_state.b3_answers,
-        },
-        "scores": {
-            "block1": st.session_state.b1_scores,
-            "block2": st.session_state.b2_scores,
-            "block3_total": st.session_state.b3_scores_total,
-            "block3_cols": st.session_state.b3_scores_cols,
-            "combined_total": total,
-        },
-        "master_report": {
-            "generated_at": None,
-            "draft_text": "",
-            "rows_override": None,
-        },
-    }
-
     # guard: не сохранять повторно при rerun
-    if "saved_result_id" not in st.session_state:
-        append_result(payload)
-        st.session_state.saved_result_id = payload["id"]
+    if "saved_result" not in st.session_state:
+        st.session_state.saved_result = save_finished_session(st.session_state)
+    payload = st.session_state.saved_result
 
     st.success("Сохранено ✅")
 
@@ -1371,6 +2675,7 @@ def render_finish_and_save():
     if st.button("Пройти заново"):
         for k in list(st.session_state.keys()):
             del st.session_state[k]
+        st.query_params.clear()
         st.rerun()
 
 
@@ -1402,13 +2707,62 @@ def format_session_title(item: Dict[str, Any]) -> str:
     return f"{name} · {created} · #{rid}"
 
 
-def build_master_table_default(scores_combined: Dict[str, float], col_scores: Dict[str, Dict[str, float]]) -> Tuple[List[str], List[str], List[str], List[List[str]]]:
-    ranked = [k for k, _ in sorted(scores_combined.items(), key=lambda x: x[1], reverse=True)]
-    row1 = ranked[:3]
-    row2 = ranked[3:6]
-    row3 = ranked[6:9]
-    table = build_3x3_table(row1, row2, row3, col_scores)
-    return row1, row2, row3, table
+MASTER_PAGE_SIZE = 25
+# всё, что нужно session_summary, — без ответов, комментариев и текстов отчёта
+SESSION_SUMMARY_FIELDS = ("id", "client_name", "created_at", "scores.combined_total", "master_report.draft_text")
+
+
+def session_summary(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Лёгкая строка индекса мастер-панели — без ответов и текстов."""
+    combined = (item.get("scores") or {}).get("combined_total") or {}
+    top = sorted(combined, key=lambda k: float(combined[k]), reverse=True)[:3]
+    return {
+        "id": item.get("id", ""),
+        "client_name": item.get("client_name") or "",
+        "created_at": item.get("created_at") or "",
+        "top": top,
+        "has_report": bool((item.get("master_report") or {}).get("draft_text")),
+    }
+
+
+def format_summary_title(summary: Dict[str, Any]) -> str:
+    top = " / ".join(POT_LABEL.get(k, k) for k in summary["top"])
+    return f"{format_session_title(summary)} · {top}" if top else format_session_title(summary)
+
+
+@st.cache_resource(max_entries=2)
+def load_session_index(storage: str, version: Tuple[int, ...]) -> Tuple[Dict[str, Any], ...]:
+    """
+    Индекс сессий (новые сверху). Ключ — версия хранилища (mtime/размер файла),
+    так что клики в панели не перечитывают историю, пока в неё никто не писал.
+    Результат общий для всех rerun-ов — не изменять.
+    """
+    summaries = [session_summary(x) for x in make_results_store(storage).iter_all(SESSION_SUMMARY_FIELDS)]
+    summaries.sort(key=lambda x: x["created_at"], reverse=True)
+    return tuple(summaries)
+
+
+@st.cache_data(max_entries=32)
+def load_session(storage: str, rid: str, version: Tuple[int, ...]) -> Optional[Dict[str, Any]]:
+    return make_results_store(storage).get(rid)
+
+
+def filter_session_index(index: Tuple[Dict[str, Any], ...], query: str) -> List[Dict[str, Any]]:
+    """Поиск по подстроке имени или по началу id (с «#» или без)."""
+    q = (query or "").strip().lower()
+    if not q:
+        return list(index)
+    rid_prefix = q.lstrip("#")
+    return [x for x in index if q in x["client_name"].lower() or x["id"].lower().startswith(rid_prefix)]
+
+
+def build_master_table_default(scores_combined: Dict[str, float], col_scores: Dict[str, Dict[str, float]]) -> Tuple[List[str], List[str], List[str], List[List[str]]]:
+    ranked = [k for k, _ in sorted(scores_combined.items(), key=lambda x: x[1], reverse=True)]
+    row1 = ranked[:3]
+    row2 = ranked[3:6]
+    row3 = ranked[6:9]
+    table = build_3x3_table(row1, row2, row3, col_scores)
+    return row1, row2, row3, table
 
 
 def render_3x3_table(table: List[List[str]]):
@@ -1425,42 +2779,346 @@ def render_3x3_table(table: List[List[str]]):
               headers[2]: [rows[0][2], rows[1][2], rows[2][2]]})
 
 
-def compose_report_prompt(session: Dict[str, Any], table: List[List[str]]) -> str:
-    # собираем тексты ответов + комментарии + deep_text
-    def extract_text(block_answers: Dict[str, Any]) -> str:
-        chunks = []
-        for qid, a in block_answers.items():
-            chunks.append(f"[{qid}] {a.get('question','')}")
-            sel = a.get("selected", [])
-            if sel:
-                for s in sel:
-                    chunks.append(f"- Выбрано: {s}")
-            c = (a.get("comment") or "").strip()
-            if c:
-                chunks.append(f"Комментарий: {c}")
-            deep = a.get("deep") or None
-            if deep:
-                motive = deep.get("motive")
-                lack = deep.get("lack")
-                dt = (deep.get("deep_text") or "").strip()
-                if motive:
-                    chunks.append(f"Почему(мотив): {motive}")
-                if lack:
-                    chunks.append(f"Если нет — что появляется: {lack}")
-                if dt:
-                    chunks.append(f"Глубинный пример: {dt}")
-            chunks.append("")
-        return "\n".join(chunks)
+# ============================
+# Кэш таблиц мастер-панели (LRU между rerun-ами)
+# ============================
 
-    answers = session.get("answers", {})
-    b1 = extract_text(answers.get("block1", {}))
-    b2 = extract_text(answers.get("block2", {}))
-    b3 = extract_text(answers.get("block3", {}))
+TABLE_MEMO_SIZE_DEFAULT = 512
+TABLE_MEMO_KINDS = ("ranked", "default", "table", "alternatives")
 
-    # таблица как ключи + русские названия
-    table_ru = [[POT_LABEL[x] for x in row] for row in table]
 
-    prompt = f"""
+def table_memo_key(session: Dict[str, Any]) -> Tuple[str, str]:
+    """(id сессии, хэш баллов): пересчёт баллов (rescore) даёт новый ключ, а не старую таблицу."""
+    scores = session.get("scores") or {}
+    raw = json.dumps([scores.get("combined_total") or {}, scores.get("block3_cols") or {}], sort_keys=True)
+    return str(session.get("id", "")), hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class TableMemo:
+    """
+    LRU на процесс: ранжирование, авто-ряды, таблица под выбранные ряды и альтернативы.
+    Значения неизменяемые (кортежи) и общие для всех сессий браузера — не изменять.
+    Считает попадания/промахи по видам для отладочной панели.
+    """
+
+    def __init__(self, max_entries: int = TABLE_MEMO_SIZE_DEFAULT):
+        self.max_entries = max(1, max_entries)
+        self._data: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = dict.fromkeys(TABLE_MEMO_KINDS, 0)
+        self.misses = dict.fromkeys(TABLE_MEMO_KINDS, 0)
+        self.evictions = 0
+
+    def get(self, kind: str, key: Tuple, compute):
+        full = (kind,) + key
+        with self._lock:
+            if full in self._data:
+                self._data.move_to_end(full)
+                self.hits[kind] += 1
+                return self._data[full]
+        # считаем без замка: два одновременных промаха дадут одинаковый результат
+        value = compute()
+        with self._lock:
+            self.misses[kind] += 1
+            self._data[full] = value
+            self._data.move_to_end(full)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            kinds = {k: {"hits": self.hits[k], "misses": self.misses[k],
+                         "hit_rate": round(self.hits[k] / max(1, self.hits[k] + self.misses[k]), 3)}
+                     for k in TABLE_MEMO_KINDS}
+            return {"size": len(self._data), "max_entries": self.max_entries,
+                    "evictions": self.evictions, "kinds": kinds}
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = dict.fromkeys(TABLE_MEMO_KINDS, 0)
+            self.misses = dict.fromkeys(TABLE_MEMO_KINDS, 0)
+            self.evictions = 0
+
+
+@st.cache_resource
+def get_table_memo() -> TableMemo:
+    try:
+        size = int(get_setting("TABLE_MEMO_SIZE", str(TABLE_MEMO_SIZE_DEFAULT)))
+    except ValueError:
+        size = TABLE_MEMO_SIZE_DEFAULT
+    return TableMemo(size)
+
+
+def _rows_key(rows: Optional[List[List[str]]]) -> Optional[Tuple[Tuple[str, ...], ...]]:
+    return None if rows is None else tuple(tuple(r) for r in rows)
+
+
+def memo_ranked(session: Dict[str, Any], key: Tuple[str, str]) -> Tuple[Tuple[str, float], ...]:
+    """Потенциалы по убыванию суммы баллов: ((ключ, балл), ...)."""
+    combined = (session.get("scores") or {}).get("combined_total") or {}
+    return get_table_memo().get("ranked", key, lambda: tuple(
+        (k, float(v)) for k, v in sorted(combined.items(), key=lambda x: x[1], reverse=True)))
+
+
+def memo_default_rows(session: Dict[str, Any], key: Tuple[str, str]) -> Tuple[Tuple[str, ...], ...]:
+    """Авто-ряды (по 3 потенциала подряд из ранжирования)."""
+    def compute():
+        ranked = [k for k, _ in memo_ranked(session, key)]
+        return tuple(tuple(ranked[i:i + 3]) for i in (0, 3, 6))
+    return get_table_memo().get("default", key, compute)
+
+
+def memo_table(session: Dict[str, Any], key: Tuple[str, str], rows: List[List[str]]) -> List[List[str]]:
+    """Таблица под выбранные ряды; возвращает свежие списки, кэш хранит кортежи."""
+    col_scores = (session.get("scores") or {}).get("block3_cols") or {}
+    table = get_table_memo().get("table", key + (_rows_key(rows),), lambda: tuple(
+        tuple(r) for r in build_3x3_table(rows[0], rows[1], rows[2], col_scores)))
+    return [list(r) for r in table]
+
+
+def memo_alternatives(session: Dict[str, Any], key: Tuple[str, str], rows: Optional[List[List[str]]],
+                      k: int = TABLE_ALTERNATIVES) -> Tuple[TableOption, ...]:
+    """Топ-k таблиц; rows=None — ряды свободные."""
+    scores = session.get("scores") or {}
+    return get_table_memo().get("alternatives", key + (_rows_key(rows), k), lambda: tuple(
+        solve_tables(scores.get("block3_cols") or {}, scores.get("combined_total") or {}, rows=rows, k=k)))
+
+
+def render_table_memo_debug():
+    """Отладочный блок в сайдбаре: заполненность LRU и доля попаданий по видам."""
+    memo = get_table_memo()
+    stats = memo.stats()
+    with st.sidebar.expander("🛠 Кэш таблиц (отладка)"):
+        st.caption(f"Записей {stats['size']}/{stats['max_entries']} · вытеснено {stats['evictions']}")
+        for kind, s in stats["kinds"].items():
+            st.text(f"{kind:<13} {s['hits']:>5} / {s['hits'] + s['misses']:<5} попаданий · {s['hit_rate']:.0%}")
+        if st.button("Сбросить кэш таблиц"):
+            memo.clear()
+            st.rerun()
+
+
+# ============================
+# Шаблонный отчёт (без LLM)
+# ============================
+
+TABLE_ROW_TITLES = ("ядро реализации", "наполнение/хобби", "делегировать/дозировать")
+TABLE_COL_TITLES = ("ВАУ (восприятие)", "Процесс (мотивация)", "Результат (действие)")
+
+
+def answer_option_ids(question: Question, a: Dict[str, Any]) -> List[str]:
+    """id выбранных вариантов ответа (по selected_ids, у старых записей — по тексту)."""
+    if "selected_ids" in a:
+        return [oid for oid in a["selected_ids"] if oid in question.option_index]
+    texts = set(a.get("selected") or [])
+    return [o.id for o in question.options if o.text in texts]
+
+
+def selected_options(answers: Dict[str, Any]) -> List[AnswerOption]:
+    """Выбранные варианты всех блоков."""
+    by_id = get_question_bank().by_id
+    out: List[AnswerOption] = []
+    for block in answers.values():
+        for qid, a in (block or {}).items():
+            q = by_id.get(qid)
+            if q is None:
+                continue
+            out.extend(q.options[q.option_index[oid]] for oid in answer_option_ids(q, a))
+    return out
+
+
+def template_facts(session: Dict[str, Any]) -> Tuple[List[str], List[Tuple[str, int]], Dict[str, List[str]]]:
+    """
+    (топ-3 потенциала по баллам, самые частые теги выбранных вариантов,
+    потенциал → тексты вариантов, которые усиливают его сильнее всего).
+    """
+    combined = (session.get("scores") or {}).get("combined_total") or {}
+    top = sorted(POTENTIALS, key=lambda k: -float(combined.get(k, 0.0)))[:3]
+    options = selected_options(session.get("answers") or {})
+
+    tags: Dict[str, int] = {}
+    examples: Dict[str, List[str]] = {k: [] for k in POTENTIALS}
+    for o in options:
+        for t in o.tags:
+            tags[t] = tags.get(t, 0) + 1
+        # пример проявления — у потенциала, который вариант усиливает сильнее всего
+        if any(o.score_changes):
+            pot = POTENTIALS[max(range(len(POTENTIALS)), key=lambda i: o.score_changes[i])]
+            if o.text not in examples[pot]:
+                examples[pot].append(o.text)
+    return top, sorted(tags.items(), key=lambda kv: -kv[1])[:4], examples
+
+
+def template_report(session: Dict[str, Any], table: List[List[str]]) -> str:
+    """
+    Черновик по правилам за миллисекунды: портрет по баллам и тегам выбранных
+    вариантов, таблица 3×3, потребность/боль каждого потенциала, энергия по рядам 2 и 3.
+    Структура как у LLM, но без раздела «Деньги/реализация» (его без модели не написать),
+    поэтому разделы пронумерованы 1–5; compose_refine_prompt просит модель его дописать.
+    """
+    combined = (session.get("scores") or {}).get("combined_total") or {}
+    top, top_tags, examples = template_facts(session)
+
+    lines = ["1) Короткий портрет"]
+    for k in top:
+        lines.append(f"- {POT_LABEL[k]} ({float(combined.get(k, 0.0)):.1f}): {POT_MEANING[k]}")
+    if top_tags:
+        lines.append("Чаще всего в выборах: " + ", ".join(f"{TAG_LABEL.get(t, t)} ×{n}" for t, n in top_tags) + ".")
+
+    lines += ["", "2) Таблица 3×3 (" + " / ".join(TABLE_COL_TITLES) + ")"]
+    for n, row in enumerate(table):
+        lines.append(f"Ряд {n + 1} ({TABLE_ROW_TITLES[n]}): " + " / ".join(POT_LABEL[k] for k in row))
+
+    lines += ["", "3) Потенциалы"]
+    for n, row in enumerate(table):
+        for c, k in enumerate(row):
+            lines.append(f"{POT_LABEL[k]} — ряд {n + 1}, {TABLE_COL_TITLES[c]}")
+            lines.append(f"- Суть: {POT_MEANING[k]}")
+            if examples[k]:
+                lines.append("- В ответах: " + "; ".join(examples[k][:2]))
+            lines.append(f"- Потребность: {POT_NEED[k]}")
+            lines.append(f"- Боль/ловушка: {POT_PAIN[k]}")
+
+    lines += ["", "4) Энергия", "Что наполняет (ряд 2 как ритуалы):"]
+    lines += [f"- {POT_LABEL[k]}: {POT_FILL[k]}" for k in table[1]]
+    lines.append("Что сжигает (ряд 3) — делегировать/дозировать:")
+    lines += [f"- {POT_LABEL[k]}: {POT_DELEGATE[k]}" for k in table[2]]
+
+    lines += ["", "5) Вопросы мастеру для интервью"]
+    lines += [f"- Где в жизни {POT_LABEL[k]} даёт тебе больше всего энергии и где ты его прячешь?" for k in table[0]]
+    lines += [f"- Что происходит, когда приходится долго заниматься «{POT_LABEL[k]}» без перерыва?" for k in table[2][:2]]
+    return "\n".join(lines)
+
+
+# ============================
+# Промпт отчёта (с бюджетом токенов)
+# ============================
+
+# общий префикс (правила + глоссарий + каталог вопросов) ≈2.8k, клиентская часть обычной сессии ≈1.9k —
+# всего ≈4.7k; худший случай — комментарий и живой пример у всех 53 ответов: после обрезки до 80
+# символов ≈7.9k. Запас ≈1.1k сверху — на неточность оценки (3 символа/токен) и рост анкеты/глоссария
+REPORT_TOKEN_BUDGET_DEFAULT = 9000
+# ступени обрезки свободного текста, если промпт не влезает в бюджет
+REPORT_TEXT_LIMITS = (None, 600, 300, 150, 80)
+
+MOTIVE_LABEL = dict(MOTIVE_OPTIONS)
+LACK_LABEL = dict(LACK_OPTIONS)
+
+
+def report_token_budget() -> int:
+    """Secret/env REPORT_TOKEN_BUDGET — потолок токенов промпта (system + user)."""
+    try:
+        return int(get_setting("REPORT_TOKEN_BUDGET", str(REPORT_TOKEN_BUDGET_DEFAULT)))
+    except ValueError:
+        return REPORT_TOKEN_BUDGET_DEFAULT
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка без токенизатора: для русского текста ~3 символа на токен (с запасом)."""
+    return (len(text) + 2) // 3
+
+
+def estimate_messages_tokens(messages: List[Dict[str, str]]) -> int:
+    # +4 на служебную разметку каждого сообщения
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)
+
+
+def prompt_budget_metrics(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    """Для metrics: оценка промпта и флаг over_budget, если не помогла даже самая жёсткая обрезка."""
+    tokens = estimate_messages_tokens(messages)
+    budget = report_token_budget()
+    return {"prompt_tokens_est": tokens, "token_budget": budget, "over_budget": tokens > budget}
+
+
+def _clip(text: str, limit: Optional[int]) -> str:
+    if limit is None or len(text) <= limit:
+        return text
+    return text[:limit].rstrip() + "…"
+
+
+def _pull_summary(selected_ids: List[str], top: int = 3) -> str:
+    """К каким потенциалам в сумме тянут выбранные варианты (по весам движка)."""
+    engine = get_scoring_engine()
+    rows = [engine.option_row_by_id[oid] for oid in selected_ids if oid in engine.option_row_by_id]
+    if not rows:
+        return "—"
+    total = engine.weights[rows].sum(axis=0)
+    order = [int(i) for i in np.argsort(-total) if total[i] > 0][:top]
+    return ", ".join(POT_LABEL[POTENTIALS[i]] for i in order) or "—"
+
+
+def _prompt_answers(answers: Dict[str, Any], level: int, text_limit: Optional[int]) -> str:
+    """
+    level 0: ответы со свободным текстом — полностью, остальные — одной строкой «[qid] выбор».
+    level 1: ответы без текста схлопываются в одну сводку на блок.
+    level 2: ответы без текста не выводятся (их уже учёл шаблонный черновик).
+    text_limit режет комментарии/deep_text, когда не помогло и это.
+    """
+    by_id = get_question_bank().by_id
+    out: List[str] = []
+    for block_key, title in (("block1", "Блок 1"), ("block2", "Блок 2"), ("block3", "Блок 3")):
+        out.append(f"--- {title} ---")
+        plain_ids: List[str] = []
+        plain_lines: List[str] = []
+        for qid, a in (answers.get(block_key) or {}).items():
+            sel = "; ".join(a.get("selected") or []) or "—"
+            deep = a.get("deep") or {}
+            texts = [(label, (value or "").strip()) for label, value in
+                     (("Комментарий", a.get("comment")), ("Глубинный пример", deep.get("deep_text")))]
+            texts = [(label, value) for label, value in texts if value]
+            if texts:
+                # текст вопроса уже есть в общем префиксе; старые/удалённые вопросы — целиком
+                out.append(f"[{qid}]" if qid in by_id else f"[{qid}] {a.get('question', '')}")
+                out.append(f"- Выбрано: {sel}")
+                out.extend(f"{label}: {_clip(value, text_limit)}" for label, value in texts)
+            else:
+                plain_ids.extend(a.get("selected_ids") or [])
+                plain_lines.append(f"[{qid}] {sel}")
+        if plain_lines:
+            if level == 0:
+                out.append("Ответы без комментариев:")
+                out.extend(plain_lines)
+            elif level == 1:
+                out.append(f"Ещё {len(plain_lines)} ответов без комментариев; "
+                           f"по выбору тянут к: {_pull_summary(plain_ids)}")
+        out.append("")
+    return "\n".join(out)
+
+
+def _prompt_deep_counts(answers: Dict[str, Any]) -> str:
+    """Мотивы/«если нет» из углублений: повторы сводим в счётчики."""
+    motives: Dict[str, int] = {}
+    lacks: Dict[str, int] = {}
+    for block in answers.values():
+        for a in (block or {}).values():
+            deep = a.get("deep") or {}
+            if deep.get("motive"):
+                motives[deep["motive"]] = motives.get(deep["motive"], 0) + 1
+            if deep.get("lack"):
+                lacks[deep["lack"]] = lacks.get(deep["lack"], 0) + 1
+
+    def fmt(counts: Dict[str, int], labels: Dict[str, str]) -> str:
+        ranked = sorted(counts.items(), key=lambda kv: -kv[1])
+        return "; ".join(f"{labels.get(k, k)} ×{n}" for k, n in ranked) or "—"
+
+    return (f"Почему цепляет (мотивы, сколько раз выбраны): {fmt(motives, MOTIVE_LABEL)}\n"
+            f"Если этого нет — что появляется: {fmt(lacks, LACK_LABEL)}")
+
+
+REPORT_SYSTEM_PROMPT = (
+    "Ты пишешь отчёт для мастера диагностики потенциалов. "
+    "Это не медицинский и не психологический диагноз. "
+    "Тон: чётко, практично, без воды."
+)
+
+# Общая для всех клиентов часть — системное сообщение целиком (см. report_static_prompt).
+# Должна оставаться байт-в-байт одинаковой между запросами: тогда провайдер кэширует
+# этот префикс (prompt caching) и не берёт за него полную цену.
+# Ничего клиентского (таблица, имена, даты) сюда не добавлять.
+REPORT_STATIC_RULES = f"""{REPORT_SYSTEM_PROMPT}
+
 Ты — ассистент мастера диагностики потенциалов (система 3×3: 3 ряда + 3 столбца).
 Важно: это ЧЕРНОВОЙ отчёт для мастера. Клиент его не видит.
 
@@ -1473,11 +3131,12 @@ def compose_report_prompt(session: Dict[str, Any], table: List[List[str]]) -> st
 - Ряд 2 = ряд наполнения/хобби/восстановления.
 - Ряд 3 = слабее/перегружает/делегировать/дозировать.
 
-Вот таблица 3×3 (в формате: Ряд1, Ряд2, Ряд3; столбцы: ВАУ/Процесс/Результат):
-{json.dumps(table_ru, ensure_ascii=False)}
+Потенциалы (глоссарий: суть; потребность; боль/ловушка; как наполняет в ряду 2; как дозировать в ряду 3):
+{chr(10).join(f"- {POT_LABEL[k]}: {POT_MEANING[k]} Потребность: {POT_NEED[k]} Боль: {POT_PAIN[k]} "
+              f"Ряд 2: {POT_FILL[k]}. Ряд 3: {POT_DELEGATE[k]}." for k in POTENTIALS)}
 
 Задача:
-Сгенерируй отчёт на русском, структурой:
+По таблице 3×3 и ответам клиента из сообщения пользователя сгенерируй отчёт на русском, структурой:
 
 1) Короткий портрет (6–10 строк).
 2) Таблица 3×3 (в тексте продублируй красиво).
@@ -1493,63 +3152,719 @@ def compose_report_prompt(session: Dict[str, Any], table: List[List[str]]) -> st
    - Что наполняет (ряд2 как ритуалы).
    - Что сжигает (ряд3) и как делегировать/дозировать.
 6) Вопросы мастеру для живого интервью (7–10 вопросов), чтобы докопаться до бессознательного «почему».
+"""
+
+
+@st.cache_resource
+def report_static_prompt() -> str:
+    """
+    Правила + глоссарий + тексты всех вопросов анкеты. В клиентской части ответы
+    ссылаются на вопросы по id, так что общий префикс длиннее порога кэширования
+    провайдера (~1024 токена), а клиентская часть короче.
+    """
+    bank = get_question_bank()
+    questions = "\n".join(f"[{q.id}] {q.text}" for q in list(bank.b1.values()) + list(bank.b2) + list(bank.b3))
+    return f"{REPORT_STATIC_RULES}\nВопросы анкеты (в ответах клиента — по id):\n{questions}\n"
+
+
+def compose_report_prompt(session: Dict[str, Any], table: List[List[str]],
+                          budget: Optional[int] = None) -> str:
+    """
+    Клиентская часть промпта (идёт после report_static_prompt()) в пределах budget токенов
+    на оба сообщения (по умолчанию REPORT_TOKEN_BUDGET).
+    Свободный текст (comment, deep_text) в приоритете: сначала схлопываются ответы
+    без комментариев, и только потом обрезаются сами тексты.
+    """
+    budget = report_token_budget() if budget is None else budget
+    answers = session.get("answers", {})
+    # таблица как ключи + русские названия
+    table_ru = [[POT_LABEL[x] for x in row] for row in table]
+
+    prompt = f"""Таблица 3×3 клиента (в формате: Ряд1, Ряд2, Ряд3; столбцы: ВАУ/Процесс/Результат):
+{json.dumps(table_ru, ensure_ascii=False)}
 
 Входные данные (ответы клиента):
 
---- Блок 1 ---
-{b1}
+{_prompt_deep_counts(answers)}
+
+"""
+    reserve = estimate_tokens(report_static_prompt()) + 8
+    text = ""
+    # последняя ступень — без ответов без комментариев вовсе (level 2) и с самой жёсткой обрезкой;
+    # не влезло и так — промпт уходит как есть, а metrics["over_budget"] это покажет
+    ladder = [(0, None)] + [(1, lim) for lim in REPORT_TEXT_LIMITS] + [(2, REPORT_TEXT_LIMITS[-1])]
+    for level, limit in ladder:
+        text = (prompt + _prompt_answers(answers, level, limit)).strip()
+        if estimate_tokens(text) + reserve <= budget:
+            break
+    return text
+
+
+OPENAI_UNAVAILABLE = "⚠️ OpenAI недоступен. Проверь `requirements.txt` (openai) и `OPENAI_API_KEY` в Secrets."
+
+# как часто сохранять недописанный черновик при потоковой генерации (в маленький файл
+# рядом, а не в историю) и как часто перерисовывать текст на странице
+REPORT_PARTIAL_SAVE_S = 5.0
+REPORT_PARTIAL_DIR = "deep_identity_report_partials"
+REPORT_STREAM_RENDER_S = 0.2
+
+
+def compose_refine_prompt(session: Dict[str, Any], table: List[List[str]],
+                          budget: Optional[int] = None) -> str:
+    """
+    Промпт доработки: сам template_report (портрет, таблица, потребности/боли,
+    энергия) + свободный текст клиента. Модель правит готовый черновик и дописывает
+    раздел «Деньги/реализация», которого в шаблоне нет, вместо отчёта с нуля.
+    """
+    budget = report_token_budget() if budget is None else budget
+    answers = session.get("answers", {})
+    prompt = f"""Ниже шаблонный черновик отчёта, собранный по правилам из баллов и выбранных вариантов.
+Доработай его до отчёта по структуре выше:
+- таблицу 3×3 (ряды и столбцы) не меняй;
+- общие формулировки замени конкретикой из комментариев и примеров клиента;
+- допиши раздел «4) Деньги/реализация» (в черновике его нет) и пронумеруй разделы как в структуре;
+- расширь вопросы мастеру до 7–10.
 
---- Блок 2 ---
-{b2}
+Шаблонный черновик:
+{template_report(session, table)}
+
+{_prompt_deep_counts(answers)}
+
+Комментарии и примеры клиента:
 
---- Блок 3 ---
-{b3}
 """
-    return prompt.strip()
+    reserve = estimate_tokens(report_static_prompt()) + 8
+    text = ""
+    for limit in REPORT_TEXT_LIMITS:
+        text = (prompt + _prompt_answers(answers, 2, limit)).strip()
+        if estimate_tokens(text) + reserve <= budget:
+            break
+    return text
+
+
+def usage_metrics(usage: Any) -> Dict[str, Any]:
+    """usage ответа → prompt_tokens, cached_tokens и доля префикса, взятая из кэша провайдера."""
+    if usage is None:
+        return {}
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    return {"prompt_tokens": prompt_tokens, "cached_tokens": cached,
+            "cached_ratio": round(cached / prompt_tokens, 3) if prompt_tokens else 0.0}
+
+
+def report_messages(session: Dict[str, Any], table: List[List[str]],
+                    refine: bool = False) -> List[Dict[str, str]]:
+    """refine=True — модель дорабатывает template_report вместо отчёта с нуля."""
+    user = compose_refine_prompt(session, table) if refine else compose_report_prompt(session, table)
+    return [
+        {"role": "system", "content": report_static_prompt()},
+        {"role": "user", "content": user},
+    ]
+
+
+# ============================
+# Кэш отчётов (по содержимому запроса)
+# ============================
+
+REPORT_CACHE_DIR = "deep_identity_report_cache"
+
+
+def report_cache_key(model: str, messages: List[Dict[str, str]]) -> str:
+    """sha256 от модели и сообщений (system + промпт): тот же запрос → тот же ключ."""
+    raw = json.dumps({"model": model, "messages": messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ReportCache:
+    """
+    Файл <key>.json на запрос. mtime = время последнего обращения;
+    при превышении max_bytes удаляются давно не читанные (LRU).
+    """
+
+    def __init__(self, path: str = REPORT_CACHE_DIR, max_bytes: int = 50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        fn = self._file(key)
+        try:
+            with open(fn, "r", encoding="utf-8") as f:
+                text = json.load(f).get("text")
+            os.utime(fn)
+        except (OSError, ValueError):
+            return None
+        return text or None
+
+    def put(self, key: str, text: str, model: str) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        atomic_write_text(self._file(key), json.dumps(
+            {"text": text, "model": model, "created_at": _now_iso()}, ensure_ascii=False))
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def get_report_cache() -> ReportCache:
+    """Secret/env REPORT_CACHE_MAX_MB (по умолчанию 50)."""
+    try:
+        max_mb = float(get_setting("REPORT_CACHE_MAX_MB", "50"))
+    except ValueError:
+        max_mb = 50.0
+    return ReportCache(max_bytes=int(max_mb * 1024 * 1024))
+
+
+# ============================
+# Бэкенды генерации отчёта
+# ============================
+
+REPORT_BACKENDS = ("openai", "local", "stub")
+REPORT_BACKEND_LABELS = {"openai": "OpenAI", "local": "локальную модель", "stub": "шаблон (без LLM)"}
+
+
+@dataclass(frozen=True)
+class ReportRequest:
+    session: Dict[str, Any]
+    table: List[List[str]]
+    messages: List[Dict[str, str]]
+
+
+class ReportBackend:
+    """
+    Источник текста черновика. Получает уже собранный промпт (и сессию с таблицей —
+    для бэкендов без LLM). complete → (текст, usage_metrics); ошибки не глотает.
+    """
+
+    name = "base"
+    model = ""
+
+    def cache_model(self) -> str:
+        """Модель в ключе кэша отчётов: разные бэкенды не должны делить записи."""
+        return f"{self.name}:{self.model}"
+
+    def complete(self, req: ReportRequest) -> Tuple[str, Dict[str, Any]]:
+        raise NotImplementedError
+
+    def stream(self, req: ReportRequest, metrics: Dict[str, Any]) -> Iterator[str]:
+        text, usage = self.complete(req)
+        metrics.update(usage)
+        yield text
+
+    async def acomplete(self, req: ReportRequest) -> Tuple[str, Dict[str, Any]]:
+        return await asyncio.to_thread(self.complete, req)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class OpenAIReportBackend(ReportBackend):
+    """Chat Completions API: OpenAI или любой совместимый сервер (base_url)."""
+
+    name = "openai"
+    stream_usage = True
+
+    def __init__(self, api_key: str, base_url: str, model: str, timeout: float = 120.0, max_retries: int = 2):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._async: Any = None
+
+    def cache_model(self) -> str:
+        # ключи кэша, накопленные до появления бэкендов, остаются валидными
+        return self.model
+
+    def client(self) -> Any:
+        return _openai_client(self.api_key, self.base_url, self.timeout, self.max_retries)
+
+    def complete(self, req: ReportRequest) -> Tuple[str, Dict[str, Any]]:
+        resp = self.client().chat.completions.create(model=self.model, messages=req.messages, temperature=0.6)
+        return resp.choices[0].message.content or "", usage_metrics(resp.usage)
+
+    def stream(self, req: ReportRequest, metrics: Dict[str, Any]) -> Iterator[str]:
+        extra = {"stream_options": {"include_usage": True}} if self.stream_usage else {}
+        stream = self.client().chat.completions.create(
+            model=self.model, messages=req.messages, temperature=0.6, stream=True, **extra)
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                metrics.update(usage_metrics(chunk.usage))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def acomplete(self, req: ReportRequest) -> Tuple[str, Dict[str, Any]]:
+        if self._async is None:
+            # повторы делает вызывающий (_chat_with_backoff), поэтому max_retries=0
+            self._async = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url or None,
+                                      timeout=self.timeout, max_retries=0)
+        resp = await self._async.chat.completions.create(model=self.model, messages=req.messages, temperature=0.6)
+        return resp.choices[0].message.content or "", usage_metrics(resp.usage)
+
+    async def aclose(self) -> None:
+        if self._async is not None:
+            await self._async.close()
+            self._async = None
+
+
+class LocalHTTPReportBackend(OpenAIReportBackend):
+    """OpenAI-совместимый локальный сервер (llama.cpp, vLLM, Ollama …) — без денег и внешней сети."""
+
+    name = "local"
+    # stream_options поддерживают не все локальные серверы
+    stream_usage = False
+
+    def cache_model(self) -> str:
+        return f"{self.name}:{self.model}"
+
+
+class StubReportBackend(ReportBackend):
+    """template_report вместо модели: нагрузочные тесты и офлайн-бенчмарки."""
+
+    name = "stub"
+    model = "template"
 
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
 
-def generate_master_report(session: Dict[str, Any], table: List[List[str]]) -> str:
-    client = get_openai_client()
-    if client is None:
-        return "⚠️ OpenAI недоступен. Проверь `requirements.txt` (openai) и `OPENAI_API_KEY` в Secrets."
+    def complete(self, req: ReportRequest) -> Tuple[str, Dict[str, Any]]:
+        if self.delay:
+            time.sleep(self.delay)
+        return template_report(req.session, req.table), {}
 
-    model = get_openai_model()
+    def stream(self, req: ReportRequest, metrics: Dict[str, Any]) -> Iterator[str]:
+        text, usage = self.complete(req)
+        metrics.update(usage)
+        for line in text.splitlines(keepends=True):
+            yield line
+
+
+def report_backend_name() -> str:
+    """
+    Secret/env REPORT_BACKEND:
+    - "openai" — OPENAI_API_KEY / OPENAI_BASE_URL / OPENAI_MODEL (по умолчанию);
+    - "local"  — OpenAI-совместимый сервер REPORT_LOCAL_URL, модель REPORT_LOCAL_MODEL;
+    - "stub"   — шаблон без LLM (REPORT_STUB_DELAY_MS — искусственная задержка).
+    """
+    name = get_setting("REPORT_BACKEND", "openai").strip().lower()
+    return name if name in REPORT_BACKENDS else "openai"
+
+
+def make_report_backend(name: str) -> Optional[ReportBackend]:
+    """None — бэкенд недоступен (нет пакета openai или ключа)."""
+    if name == "stub":
+        try:
+            delay = float(get_setting("REPORT_STUB_DELAY_MS", "0")) / 1000
+        except ValueError:
+            delay = 0.0
+        return StubReportBackend(delay)
+    if OpenAI is None:
+        return None
+    timeout, max_retries = openai_limits()
+    if name == "local":
+        return LocalHTTPReportBackend(get_setting("REPORT_LOCAL_API_KEY", "local"),
+                                      get_setting("REPORT_LOCAL_URL", "http://127.0.0.1:8080/v1"),
+                                      get_setting("REPORT_LOCAL_MODEL", "local"), timeout, max_retries)
+    api_key = get_setting("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    return OpenAIReportBackend(api_key, get_setting("OPENAI_BASE_URL"), get_openai_model(), timeout, max_retries)
+
+
+def get_report_backend() -> Optional[ReportBackend]:
+    return make_report_backend(report_backend_name())
+
+
+# ============================
+# Генерация черновика
+# ============================
+
+def generate_master_report(session: Dict[str, Any], table: List[List[str]],
+                           metrics: Optional[Dict[str, Any]] = None, use_cache: bool = True,
+                           backend: Optional[ReportBackend] = None, refine: bool = False) -> str:
+    backend = backend or get_report_backend()
+    if backend is None:
+        return OPENAI_UNAVAILABLE
+
+    model = backend.model
+    messages = report_messages(session, table, refine)
+    metrics = metrics if metrics is not None else {}
+    metrics.update({"backend": backend.name, "model": model, "streamed": False, "cached": False, "refine": refine,
+                    **prompt_budget_metrics(messages)})
+    cache = get_report_cache()
+    key = report_cache_key(backend.cache_model(), messages)
+    t0 = time.perf_counter()
+    if use_cache:
+        cached = cache.get(key)
+        if cached:
+            metrics.update({"cached": True, "total_s": round(time.perf_counter() - t0, 3)})
+            return cached
+    try:
+        text, usage = backend.complete(ReportRequest(session, table, messages))
+        metrics["total_s"] = round(time.perf_counter() - t0, 3)
+        metrics.update(usage)
+        # use_cache=False (бенчмарки, «новый вариант») — кэш не читаем и не засоряем
+        if text and use_cache:
+            cache.put(key, text, model)
+        return text
+    except Exception as e:
+        name = "OpenAI" if backend.name == "openai" else backend.name
+        return f"⚠️ Ошибка при запросе к {name}:\n\n{e}"
+
+
+def stream_master_report(session: Dict[str, Any], table: List[List[str]],
+                         metrics: Dict[str, Any], use_cache: bool = True, refine: bool = False) -> Iterator[str]:
+    """
+    То же, что generate_master_report, но отдаёт текст кусками по мере генерации.
+    В metrics пишет ttft_s (время до первого токена) и total_s.
+    Ошибки запроса не глотает — вызывающий сохраняет то, что успело прийти.
+    """
+    backend = get_report_backend()
+    if backend is None:
+        yield OPENAI_UNAVAILABLE
+        return
+
+    model = backend.model
+    messages = report_messages(session, table, refine)
+    metrics.update({"backend": backend.name, "model": model, "streamed": True, "cached": False, "refine": refine,
+                    **prompt_budget_metrics(messages)})
+    cache = get_report_cache()
+    key = report_cache_key(backend.cache_model(), messages)
+    t0 = time.perf_counter()
+    if use_cache:
+        cached = cache.get(key)
+        if cached:
+            metrics.update({"cached": True, "ttft_s": round(time.perf_counter() - t0, 3)})
+            metrics["total_s"] = metrics["ttft_s"]
+            yield cached
+            return
+
+    parts: List[str] = []
+    for delta in backend.stream(ReportRequest(session, table, messages), metrics):
+        if "ttft_s" not in metrics:
+            metrics["ttft_s"] = round(time.perf_counter() - t0, 3)
+        parts.append(delta)
+        yield delta
+    metrics["total_s"] = round(time.perf_counter() - t0, 3)
+    if parts and use_cache:
+        cache.put(key, "".join(parts), model)
+
+
+def save_master_draft(session: Dict[str, Any], draft: str, rows_override: Dict[str, Any],
+                      metrics: Optional[Dict[str, Any]] = None, partial: bool = False) -> None:
+    mr = session.setdefault("master_report", {})
+    mr["draft_text"] = draft
+    mr["generated_at"] = _now_iso()
+    mr["rows_override"] = rows_override
+    mr["partial"] = partial
+    if metrics is not None:
+        mr["metrics"] = dict(metrics)
+    update_result(session)
+
+
+def _report_partial_path(session_id: str) -> str:
+    return os.path.join(REPORT_PARTIAL_DIR, re.sub(r"[^\w-]", "_", session_id) + ".json")
+
+
+def save_report_partial(session_id: str, draft: str, rows_override: Dict[str, Any], metrics: Dict[str, Any]) -> None:
+    """Недописанный черновик — в отдельный файл: историю сессий при этом не переписываем."""
+    os.makedirs(REPORT_PARTIAL_DIR, exist_ok=True)
+    atomic_write_text(_report_partial_path(session_id), json.dumps(
+        {"draft_text": draft, "saved_at": _now_iso(), "rows_override": rows_override, "metrics": metrics},
+        ensure_ascii=False))
+
+
+def load_report_partial(session_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_report_partial_path(session_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def drop_report_partial(session_id: str) -> None:
+    try:
+        os.remove(_report_partial_path(session_id))
+    except OSError:
+        pass
+
+
+def render_report_stream(session: Dict[str, Any], table: List[List[str]], rows_override: Dict[str, Any],
+                         use_cache: bool = True, refine: bool = False) -> bool:
+    """
+    Печатает черновик по мере генерации (не чаще REPORT_STREAM_RENDER_S) и раз в
+    REPORT_PARTIAL_SAVE_S кладёт недописанное в файл рядом (save_report_partial).
+    В историю черновик пишется один раз — по завершении или при ошибке.
+    False — генерация оборвалась (частичный черновик сохранён, ошибка показана).
+    """
+    metrics: Dict[str, Any] = {}
+    text = ""
+    last_save = last_render = time.monotonic()
+    placeholder = st.empty()
+    try:
+        for delta in stream_master_report(session, table, metrics, use_cache=use_cache, refine=refine):
+            text += delta
+            now = time.monotonic()
+            if now - last_render >= REPORT_STREAM_RENDER_S:
+                placeholder.markdown(text + " ▌")
+                last_render = now
+            if now - last_save >= REPORT_PARTIAL_SAVE_S:
+                save_report_partial(session["id"], text, rows_override, metrics)
+                last_save = now
+    except Exception as e:
+        text += f"\n\n⚠️ Генерация прервалась: {e}"
+        save_master_draft(session, text, rows_override, metrics, partial=True)
+        drop_report_partial(session["id"])
+        placeholder.markdown(text)
+        st.error("Черновик сохранён частично — можно сгенерировать заново.")
+        return False
+    save_master_draft(session, text, rows_override, metrics)
+    drop_report_partial(session["id"])
+    return True
+
+
+# ============================
+# Фоновые задачи отчётов (переживают rerun и перезагрузку страницы)
+# ============================
+
+REPORT_JOB_ACTIVE = ("queued", "running")
+
+
+class ReportJobStore:
+    """
+    Таблица задач в SQLite рядом с результатами: статус виден из любого rerun/вкладки
+    и переживает перезапуск процесса (незавершённые задачи ставятся заново).
+    """
 
-    system = (
-        "Ты пишешь отчёт для мастера диагностики потенциалов. "
-        "Это не медицинский и не психологический диагноз. "
-        "Тон: чётко, практично, без воды."
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS report_jobs ("
+        " id TEXT PRIMARY KEY,"
+        " session_id TEXT NOT NULL,"
+        " status TEXT NOT NULL,"
+        " params TEXT NOT NULL,"
+        " created_at TEXT,"
+        " started_at TEXT,"
+        " finished_at TEXT,"
+        " error TEXT)",
+        "CREATE INDEX IF NOT EXISTS idx_report_jobs_session ON report_jobs(session_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_report_jobs_status ON report_jobs(status)",
     )
-    prompt = compose_report_prompt(session, table)
+    COLUMNS = ("id", "session_id", "status", "params", "created_at", "started_at", "finished_at", "error")
 
+    def __init__(self, path: str = REPORT_JOBS_DB_FILE):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _job(self, row: Optional[Tuple[Any, ...]]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(zip(self.COLUMNS, row))
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def create(self, session_id: str, params: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """
+        (задача, создана ли новая). Если по сессии уже есть активная — возвращает её:
+        второй платный запрос не нужен.
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM report_jobs WHERE session_id = ? AND status IN (?, ?)",
+                (session_id, *REPORT_JOB_ACTIVE)).fetchone()
+            if row:
+                return self._job(row), False  # type: ignore[return-value]
+            job = {"id": uuid.uuid4().hex, "session_id": session_id, "status": "queued", "params": params,
+                   "created_at": _now_iso(), "started_at": None, "finished_at": None, "error": None}
+            conn.execute(f"INSERT INTO report_jobs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                         tuple(json.dumps(v, ensure_ascii=False) if k == "params" else v for k, v in job.items()))
+        return job, True
+
+    def claim(self, job_id: str) -> bool:
+        """queued → running; False — задачу уже взял другой поток."""
+        with closing(self._connect()) as conn, conn:
+            cur = conn.execute("UPDATE report_jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'queued'",
+                               (_now_iso(), job_id))
+        return cur.rowcount == 1
+
+    def requeue_running(self) -> int:
+        """После перезапуска процесса «running» никто не выполняет — возвращаем в очередь."""
+        with closing(self._connect()) as conn, conn:
+            cur = conn.execute("UPDATE report_jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+        return cur.rowcount
+
+    def finish(self, job_id: str, error: Optional[str] = None) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE report_jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                         ("failed" if error else "done", error, _now_iso(), job_id))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM report_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row)
+
+    def latest(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM report_jobs WHERE session_id = ? "
+                "ORDER BY created_at DESC, rowid DESC LIMIT 1", (session_id,)).fetchone()
+        return self._job(row)
+
+    def active(self) -> List[Dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM report_jobs WHERE status IN (?, ?) ORDER BY rowid",
+                REPORT_JOB_ACTIVE).fetchall()
+        return [self._job(r) for r in rows]  # type: ignore[misc]
+
+
+def _run_report_job(jobs: ReportJobStore, job_id: str) -> None:
+    if not jobs.claim(job_id):
+        return
+    job = jobs.get(job_id)
+    if job is None:
+        # строку задачи удалили между claim и чтением — сообщить о результате некуда
+        return
     try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.6,
-        )
-        return resp.choices[0].message.content
+        session = get_result(job["session_id"])
+        if session is None:
+            raise RuntimeError(f"сессия {job['session_id']} не найдена")
+        params = job["params"]
+        rows_override = params["rows_override"]
+        metrics: Dict[str, Any] = {"background": True}
+        draft = generate_master_report(session, rows_override["table"], metrics,
+                                       use_cache=params.get("use_cache", True), refine=params.get("refine", False))
+        if not draft or draft.startswith("⚠️"):
+            raise RuntimeError(draft or "пустой ответ модели")
+        # пока шёл запрос, сессию могли поменять — пишем черновик в свежую версию
+        save_master_draft(get_result(job["session_id"]) or session, draft, rows_override, metrics)
     except Exception as e:
-        return f"⚠️ Ошибка при запросе к OpenAI:\n\n{e}"
+        jobs.finish(job_id, str(e))
+    else:
+        jobs.finish(job_id)
+
+
+class ReportJobRunner:
+    """Пул потоков на процесс; задачи и статусы — в ReportJobStore."""
+
+    def __init__(self, jobs: ReportJobStore, workers: int):
+        self.jobs = jobs
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report-job")
+        # процесс перезапустился: всё, что стояло в очереди или выполнялось, запускаем заново
+        jobs.requeue_running()
+        for job in jobs.active():
+            self.pool.submit(_run_report_job, jobs, job["id"])
+
+    def submit(self, session_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        job, created = self.jobs.create(session_id, params)
+        if created:
+            self.pool.submit(_run_report_job, self.jobs, job["id"])
+        return job
+
+
+@st.cache_resource
+def get_report_job_runner() -> ReportJobRunner:
+    """Secret/env REPORT_JOB_WORKERS — сколько отчётов генерировать параллельно (по умолчанию 2)."""
+    try:
+        workers = int(get_setting("REPORT_JOB_WORKERS", "2"))
+    except ValueError:
+        workers = 2
+    return ReportJobRunner(ReportJobStore(), max(1, workers))
+
+
+REPORT_JOB_STATUS_LABELS = {"queued": "в очереди", "running": "генерируется", "done": "готово", "failed": "ошибка"}
+
+
+@st.fragment(run_every=2)
+def render_report_job_status(session_id: str, job_id: str) -> None:
+    """Опрос статуса без перезапуска всей страницы; по завершении — полный rerun, чтобы показать черновик."""
+    job = get_report_job_runner().jobs.get(job_id)
+    if job is None:
+        return
+    if job["status"] in REPORT_JOB_ACTIVE:
+        st.info(f"⏳ Черновик {REPORT_JOB_STATUS_LABELS[job['status']]} в фоне (с {job['created_at']}). "
+                "Можно уходить со страницы — результат сохранится сам.")
+    elif st.session_state.get(f"report_job_seen_{session_id}") != job_id:
+        st.session_state[f"report_job_seen_{session_id}"] = job_id
+        st.rerun(scope="app")
 
 
 def render_master():
     st.title("Deep Identity · Мастер-панель Асели")
     st.caption("Здесь только ты видишь клиентов, их ответы и генерируешь отчёты.")
+    render_table_memo_debug()
 
-    sessions = load_results()
-    if not sessions:
-        st.warning("Пока нет ни одной записи в deep_identity_results.json.")
+    storage = results_storage()
+    store = make_results_store(storage)
+    index = load_session_index(storage, store.version())
+    if not index:
+        st.warning(f"Пока нет ни одной записи в {store.path}.")
         st.info("Если это Streamlit Cloud: в одном общем app всё будет сохраняться здесь после прохождения клиентом.")
         return
 
-    sessions_sorted = sorted(sessions, key=lambda x: x.get("created_at", ""), reverse=True)
-    labels = [format_session_title(x) for x in sessions_sorted]
-    pick = st.selectbox("Выбери клиента", options=list(range(len(labels))), format_func=lambda i: labels[i])
-    session = sessions_sorted[pick]
+    without_report = sum(1 for x in index if not x["has_report"])
+    if without_report:
+        with st.expander(f"📦 Черновики для всех без отчёта ({without_report})"):
+            st.caption("Параллельные запросы к модели; готовые черновики сохраняются пачками.")
+            concurrency = st.slider("Одновременных запросов", 1, 16, 4)
+            if st.button("Сгенерировать все недостающие черновики"):
+                bar = st.progress(0.0)
+                try:
+                    stats = bulk_generate_reports(concurrency=concurrency,
+                                                  on_progress=lambda d, t: bar.progress(d / max(1, t)))
+                except RuntimeError as e:
+                    st.error(str(e))
+                else:
+                    st.success(f"Готово: новых {stats['generated']}, из кэша {stats['cached']}, "
+                               f"ошибок {stats['failed']} · {stats['elapsed_s']} с")
+                    for err in stats["errors"][:5]:
+                        st.caption(err)
+    render_export_panel()
+
+    query = st.text_input("Поиск клиента", placeholder="Имя или #id")
+    found = filter_session_index(index, query)
+    if not found:
+        st.info("Никого не нашлось.")
+        return
+    pages = (len(found) + MASTER_PAGE_SIZE - 1) // MASTER_PAGE_SIZE
+    page = 1
+    if pages > 1:
+        page = int(st.number_input("Страница", min_value=1, max_value=pages, value=1, step=1))
+    page_items = found[(page - 1) * MASTER_PAGE_SIZE: page * MASTER_PAGE_SIZE]
+    st.caption(f"Найдено: {len(found)} из {len(index)} · страница {page}/{pages}")
+
+    titles = {x["id"]: format_summary_title(x) for x in page_items}
+    pick = st.selectbox("Выбери клиента", options=list(titles), format_func=titles.__getitem__)
+    session = load_session(storage, pick, store.version())
+    if session is None:
+        st.error("Запись не найдена — возможно, хранилище только что изменилось. Обнови страницу.")
+        return
 
     st.markdown("### Данные клиента")
     st.write(f"**Имя:** {session.get('client_name') or '—'}")
@@ -1558,17 +3873,13 @@ def render_master():
 
     st.markdown("---")
     st.markdown("### Сырые суммы (для ориентира)")
-    combined = session.get("scores", {}).get("combined_total", {})
-    if combined:
-        ranked = sorted(combined.items(), key=lambda x: x[1], reverse=True)
-        for k, v in ranked:
-            st.write(f"- **{POT_LABEL.get(k, k)}**: {round(float(v), 2)}")
+    memo_key = table_memo_key(session)
+    for k, v in memo_ranked(session, memo_key):
+        st.write(f"- **{POT_LABEL.get(k, k)}**: {round(v, 2)}")
 
     st.markdown("---")
     st.markdown("## Таблица 3×3")
-    col_scores = session.get("scores", {}).get("block3_cols", {})
-
-    row1_def, row2_def, row3_def, table_def = build_master_table_default(combined, col_scores)
+    row1_def, row2_def, row3_def = (list(r) for r in memo_default_rows(session, memo_key))
 
     st.markdown("### Авто-предложение рядов (можно поправить)")
     colA, colB, colC = st.columns(3)
@@ -1587,9 +3898,21 @@ def render_master():
         st.error("Нужно выбрать ровно 3+3+3 и без повторов (в сумме 9 разных потенциалов).")
         st.stop()
 
-    table = build_3x3_table(row1, row2, row3, col_scores)
+    table = memo_table(session, memo_key, [row1, row2, row3])
     render_3x3_table(table)
 
+    with st.expander(f"Альтернативные таблицы (топ-{TABLE_ALTERNATIVES})"):
+        free = st.toggle("Разрешить переносить потенциалы между рядами (с учётом ранга)", value=False)
+        alt_rows = None if free else [row1, row2, row3]
+        options = memo_alternatives(session, memo_key, alt_rows)
+        scores = session.get("scores") or {}
+        current = current_option_index(list(options), table, table_score(
+            scores.get("block3_cols") or {}, scores.get("combined_total") or {}, alt_rows, table))
+        for n, opt in enumerate(options, start=1):
+            mark = " · текущая" if n - 1 == current else ""
+            st.caption(f"Вариант {n} · оценка {opt.score:.2f}{mark}")
+            st.text("\n".join(f"Ряд {r + 1}: " + " / ".join(POT_LABEL[p] for p in row) for r, row in enumerate(opt.table)))
+
     st.markdown("---")
     st.markdown("## Ответы клиента (включая комментарии)")
     with st.expander("Показать все ответы"):
@@ -1597,9 +3920,46 @@ def render_master():
 
     st.markdown("---")
     st.markdown("## Черновой отчёт (только для мастера)")
+    job = get_report_job_runner().jobs.latest(session["id"])
+    if job and job["status"] in REPORT_JOB_ACTIVE:
+        render_report_job_status(session["id"], job["id"])
+    elif job and job["status"] == "failed":
+        st.error(f"Фоновая генерация не удалась ({job['finished_at']}): {job['error']}")
+    partial = load_report_partial(session["id"])
+    # старше сохранённого черновика — его уже перекрыли (шаблон, фоновая задача, новая генерация)
+    if partial and partial.get("saved_at", "") < ((session.get("master_report") or {}).get("generated_at") or ""):
+        drop_report_partial(session["id"])
+        partial = None
+    if partial:
+        # поток оборвался без исключения (перезагрузка страницы, переход) — остался только файл рядом
+        st.warning(f"Есть недописанный черновик ({partial.get('saved_at', '')}): генерация не дошла до конца.")
+        with st.expander("Показать недописанный черновик"):
+            st.text(partial.get("draft_text", ""))
+        c1, c2 = st.columns(2)
+        if c1.button("Сохранить как частичный черновик"):
+            save_master_draft(session, partial.get("draft_text", ""), partial.get("rows_override") or {},
+                              partial.get("metrics") or {}, partial=True)
+            drop_report_partial(session["id"])
+            st.rerun()
+        if c2.button("Удалить недописанный черновик"):
+            drop_report_partial(session["id"])
+            st.rerun()
     mr = session.get("master_report", {}) or {}
     if mr.get("draft_text"):
-        st.success("Есть сохранённый черновик отчёта.")
+        if mr.get("partial"):
+            st.warning("Черновик сохранён частично (генерация не дошла до конца).")
+        else:
+            st.success("Есть сохранённый черновик отчёта.")
+        m = mr.get("metrics") or {}
+        if m.get("cached"):
+            st.caption(f"⚡ {m.get('model', '')} · из кэша: без запроса к модели и без токенов")
+        elif m:
+            ttft = f"первый токен {m['ttft_s']} с · " if "ttft_s" in m else ""
+            prefix = (f" · из кэша префикса {m['cached_tokens']}/{m['prompt_tokens']} токенов промпта"
+                      if m.get("prompt_tokens") else "")
+            over = (f" · ⚠️ промпт сверх бюджета ({m['prompt_tokens_est']}/{m['token_budget']})"
+                    if m.get("over_budget") else "")
+            st.caption(f"{m.get('model', '')} · {ttft}всего {m.get('total_s', '—')} с{prefix}{over}")
         st.text_area("Черновик", mr.get("draft_text", ""), height=350)
         st.download_button(
             "⬇️ Скачать черновик отчёта",
@@ -1608,15 +3968,1167 @@ def render_master():
             mime="text/plain; charset=utf-8"
         )
 
-    if st.button("✨ Сгенерировать/обновить черновик отчёта через OpenAI"):
-        with st.spinner("Генерирую отчёт…"):
-            draft = generate_master_report(session, table)
-        session["master_report"]["draft_text"] = draft
-        session["master_report"]["generated_at"] = _now_iso()
-        session["master_report"]["rows_override"] = {"row1": row1, "row2": row2, "row3": row3, "table": table}
-        update_result(session)
+    rows_override = {"row1": row1, "row2": row2, "row3": row3, "table": table}
+    if st.button("⚡ Мгновенный черновик по шаблону (без модели)"):
+        t0 = time.perf_counter()
+        draft = template_report(session, table)
+        save_master_draft(session, draft, rows_override,
+                          {"backend": "template", "model": "template", "total_s": round(time.perf_counter() - t0, 3)})
         st.rerun()
 
+    refine = st.checkbox("Модель дорабатывает шаблонный черновик", value=False,
+                         help="В промпт идёт ⚡-черновик и свободный текст клиента; модель правит его "
+                              "и дописывает раздел «Деньги/реализация».")
+    pb = prompt_budget_metrics(report_messages(session, table, refine))
+    over = " · ⚠️ не влезает даже после обрезки текстов" if pb["over_budget"] else ""
+    st.caption(f"Промпт: ≈{pb['prompt_tokens_est']} токенов (бюджет {pb['token_budget']}; REPORT_TOKEN_BUDGET){over}")
+    streaming = st.checkbox("Показывать текст по мере генерации", value=True,
+                            help="Без галочки отчёт генерируется в фоне: переживает обновление страницы и переходы.")
+    fresh = st.checkbox("Новый вариант (не брать из кэша)", value=False,
+                        help="Без галочки тот же запрос (ответы + таблица + модель) вернётся из кэша мгновенно.")
+    if st.button(f"✨ Сгенерировать/обновить черновик отчёта через {REPORT_BACKEND_LABELS[report_backend_name()]}"):
+        if streaming:
+            if render_report_stream(session, table, rows_override, use_cache=not fresh, refine=refine):
+                st.rerun()
+        else:
+            get_report_job_runner().submit(session["id"], {"rows_override": rows_override,
+                                                           "use_cache": not fresh, "refine": refine})
+            st.rerun()
+
+
+# ============================
+# Аналитика по всем сессиям (pandas)
+# ============================
+
+@st.cache_resource
+def cohort_columns() -> Dict[str, List[str]]:
+    """Имена колонок кадра когорты по группам (варианты — в порядке строк ScoringEngine). Не изменять."""
+    engine = get_scoring_engine()
+    options = sorted(engine.option_row_by_id, key=engine.option_row_by_id.__getitem__)
+    question_of_row = {row: qid for qid, rows in engine.option_rows.items() for row in rows}
+    return {
+        "total": [f"total:{p}" for p in POTENTIALS],
+        "cols": [f"{c}:{p}" for c in TABLE_COLS for p in POTENTIALS],
+        "opt": [f"opt:{oid}" for oid in options],
+        "ans": [f"ans:{qid}" for qid in engine.option_rows],
+        "question_of_opt": [question_of_row[engine.option_row_by_id[oid]] for oid in options],
+    }
+
+
+def cohort_rows(items: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Записи → кадр «строка = сессия» (индекс — id): мета, combined_total, block3_cols,
+    выбор каждого варианта (opt:<id>, 0/1) и факт ответа на вопрос (ans:<qid>).
+    Записи без id пропускаются.
+    """
+    items = [x for x in items if x.get("id")]
+    engine = get_scoring_engine()
+    names = cohort_columns()
+    n_opts = len(names["opt"])
+    qpos = {qid: i for i, qid in enumerate(engine.option_rows)}
+
+    totals = np.zeros((len(items), len(POTENTIALS)))
+    cols = np.zeros((len(items), len(TABLE_COLS), len(POTENTIALS)))
+    picks = np.zeros((len(items), n_opts), dtype=np.uint8)
+    answered = np.zeros((len(items), len(qpos)), dtype=bool)
+    for i, x in enumerate(items):
+        scores = x.get("scores") or {}
+        combined = scores.get("combined_total") or {}
+        totals[i] = [float(combined.get(p, 0.0)) for p in POTENTIALS]
+        cols[i] = column_matrix(scores.get("block3_cols") or {}).T
+        answers = x.get("answers") or {}
+        # строки мотивов/дефицитов идут после вариантов — их отсекаем
+        rows = [r for _, r in engine.selection(answers) if r < n_opts]
+        picks[i, rows] = 1
+        qids = [qpos[q] for block in answers.values() for q in (block or {}) if q in qpos]
+        answered[i, qids] = True
+
+    meta = pd.DataFrame({
+        "client_name": [x.get("client_name") or "" for x in items],
+        "created_at": pd.to_datetime([x.get("created_at") for x in items], errors="coerce"),
+        "started_at": pd.to_datetime([x.get("started_at") for x in items], errors="coerce"),
+        "has_report": [bool((x.get("master_report") or {}).get("draft_text")) for x in items],
+    }, index=pd.Index([x["id"] for x in items], name="id"))
+    meta["duration_s"] = (meta["created_at"] - meta["started_at"]).dt.total_seconds()
+    parts = [
+        meta,
+        pd.DataFrame(totals, index=meta.index, columns=names["total"]),
+        pd.DataFrame(cols.reshape(len(items), len(names["cols"])), index=meta.index, columns=names["cols"]),
+        pd.DataFrame(picks, index=meta.index, columns=names["opt"]),
+        pd.DataFrame(answered, index=meta.index, columns=names["ans"]),
+    ]
+    return pd.concat(parts, axis=1)
+
+
+class CohortFrame:
+    """
+    Кадр когорты на процесс. refresh() при изменении версии хранилища дочитывает
+    только новые и обновлённые записи (read_since: хвост jsonl, seq в sqlite)
+    и дописывает/заменяет их строки по id; полная пересборка — если хранилище
+    переписано (json — при каждой записи) или по кнопке.
+    """
+
+    def __init__(self, storage: str):
+        self.storage = storage
+        self.frame = cohort_rows([])
+        self.cursor: Any = None
+        self.version: Optional[Tuple[int, ...]] = None
+        self._lock = threading.Lock()
+
+    def refresh(self, full: bool = False) -> int:
+        """Сколько записей прочитано."""
+        store = make_results_store(self.storage)
+        version = store.version()
+        with self._lock:
+            if version == self.version and not full:
+                return 0
+            items, cursor, reset = store.read_since(None if full else self.cursor)
+            batch = cohort_rows(items)
+            if reset or full:
+                frame = batch
+            else:
+                frame = pd.concat([self.frame.drop(index=batch.index, errors="ignore"), batch])
+            self.frame = frame[~frame.index.duplicated(keep="last")]
+            self.cursor, self.version = cursor, version
+            return len(items)
+
+
+@st.cache_resource
+def get_cohort_frame(storage: str) -> CohortFrame:
+    return CohortFrame(storage)
+
+
+def cohort_row1_cooccurrence(frame: pd.DataFrame) -> pd.DataFrame:
+    """9×9: сколько раз пара потенциалов вместе попала в авто-ряд 1 (топ-3 по сумме); диагональ — сам потенциал."""
+    totals = frame[cohort_columns()["total"]].to_numpy()
+    top3 = np.argsort(-totals, axis=1, kind="stable")[:, :3]     # порядок равных — как у build_master_table_default
+    member = np.zeros(totals.shape, dtype=np.int64)
+    np.put_along_axis(member, top3, 1, axis=1)
+    labels = [POT_LABEL[p] for p in POTENTIALS]
+    return pd.DataFrame(member.T @ member, index=labels, columns=labels)
+
+
+def cohort_pick_rates(frame: pd.DataFrame) -> pd.DataFrame:
+    """Доля выбравших вариант среди ответивших на вопрос (вопросы блока 1 задаются не всем)."""
+    names = cohort_columns()
+    bank = get_question_bank()
+    picks = frame[names["opt"]].to_numpy().sum(axis=0)
+    answered = frame[names["ans"]].to_numpy().sum(axis=0)
+    qpos = {qid: i for i, qid in enumerate(c[len("ans:"):] for c in names["ans"])}
+    asked = answered[[qpos[q] for q in names["question_of_opt"]]]
+    oids = [c[len("opt:"):] for c in names["opt"]]
+    return pd.DataFrame({
+        "вопрос": [bank.by_id[q].text for q in names["question_of_opt"]],
+        "вариант": [bank.by_id[q].option_text(oid) for q, oid in zip(names["question_of_opt"], oids)],
+        "выбрали": picks,
+        "ответили": asked,
+        "доля": np.divide(picks, asked, out=np.zeros(len(picks)), where=asked > 0).round(3),
+    }, index=pd.Index(oids, name="id"))
+
+
+def cohort_potential_stats(frame: pd.DataFrame) -> pd.DataFrame:
+    """Распределение сумм баллов по потенциалам + доля сессий, где потенциал первый."""
+    totals = frame[cohort_columns()["total"]]
+    stats = totals.describe(percentiles=[0.25, 0.5, 0.75]).T.drop(columns="count")
+    first = totals.to_numpy().argmax(axis=1)
+    stats["топ-1, доля"] = np.bincount(first, minlength=len(POTENTIALS)) / max(1, len(totals))
+    stats.index = [POT_LABEL[p] for p in POTENTIALS]
+    return stats.round(2)
+
+
+def render_analytics():
+    st.title("Deep Identity · Аналитика по всем клиентам")
+    cohort = get_cohort_frame(results_storage())
+    full = st.button("Пересобрать с нуля")
+    t0 = time.perf_counter()
+    read = cohort.refresh(full=full)
+    frame = cohort.frame
+    st.caption(f"Сессий: {len(frame)} · дочитано записей: {read} за {time.perf_counter() - t0:.2f} с")
+    if frame.empty:
+        st.info("Пока нет ни одной сессии.")
+        return
+
+    st.markdown("### Распределение баллов по потенциалам")
+    st.dataframe(cohort_potential_stats(frame))
+    st.bar_chart(frame[cohort_columns()["total"]].rename(columns=lambda c: POT_LABEL[c[len("total:"):]]).mean())
+
+    st.markdown("### Ряд 1: какие потенциалы встречаются вместе")
+    st.caption("Топ-3 по сумме баллов (авто-ряд 1). На диагонали — сколько раз потенциал попал в ряд 1.")
+    st.dataframe(cohort_row1_cooccurrence(frame))
+
+    st.markdown("### Как часто выбирают варианты")
+    rates = cohort_pick_rates(frame)
+    questions = list(dict.fromkeys(rates["вопрос"]))
+    picked = st.selectbox("Вопрос", options=["Все вопросы"] + questions)
+    st.dataframe(rates if picked == "Все вопросы" else rates[rates["вопрос"] == picked], hide_index=True)
+
+    st.markdown("### Время прохождения")
+    minutes = frame["duration_s"].dropna() / 60
+    if minutes.empty:
+        st.caption("У записей нет started_at (сохранены до автосохранения) — время неизвестно.")
+    else:
+        st.caption(f"Медиана {minutes.median():.1f} мин · 90% укладываются в {minutes.quantile(0.9):.1f} мин · "
+                   f"по {len(minutes)} из {len(frame)} сессий")
+        bins = pd.cut(minutes, bins=[0, 5, 10, 15, 20, 30, 45, 60, np.inf], right=False)
+        st.bar_chart(bins.value_counts(sort=False).rename(index=str))
+    st.markdown("#### Сессий по дням")
+    st.bar_chart(frame["created_at"].dt.date.value_counts().sort_index())
+
+
+# ============================
+# Выгрузка истории (Parquet/CSV по частям)
+# ============================
+
+EXPORT_DIR = "deep_identity_exports"
+EXPORT_FORMATS = ("parquet", "csv")
+EXPORT_CHUNK_DEFAULT = 500
+
+
+def export_sessions_frame(items: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Строка на сессию: мета + combined_total + block3_cols (те же колонки, что в аналитике, без выборов)."""
+    names = cohort_columns()
+    return cohort_rows(items).drop(columns=names["opt"] + names["ans"]).reset_index()
+
+
+def export_answers_frame(items: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Строка на ответ: сессия, блок, вопрос, id выбранных вариантов, мотив/дефицит, длины текстов."""
+    by_id = get_question_bank().by_id
+    rows = []
+    for x in items:
+        for block_key, block in (x.get("answers") or {}).items():
+            for qid, a in (block or {}).items():
+                q = by_id.get(qid)
+                deep = a.get("deep") or {}
+                oids = answer_option_ids(q, a) if q is not None else list(a.get("selected_ids") or [])
+                rows.append({
+                    "session_id": x.get("id") or "",
+                    "block": int(block_key[len("block"):]) if block_key[len("block"):].isdigit() else 0,
+                    "question_id": qid,
+                    "group": a.get("group") or "",
+                    "option_ids": oids,
+                    "n_selected": len(oids),
+                    "motive": deep.get("motive") or "",
+                    "lack": deep.get("lack") or "",
+                    "comment_len": len(a.get("comment") or ""),
+                    "deep_text_len": len(deep.get("deep_text") or ""),
+                })
+    columns = ["session_id", "block", "question_id", "group", "option_ids", "n_selected",
+               "motive", "lack", "comment_len", "deep_text_len"]
+    return pd.DataFrame(rows, columns=columns).astype({"block": "int8", "n_selected": "int16",
+                                                       "comment_len": "int32", "deep_text_len": "int32"})
+
+
+def export_schema(name: str) -> "pa.Schema":
+    """
+    Явная схема Parquet: по первой части её выводить нельзя — например, часть из одних
+    ответов-комментариев даёт option_ids: list<null>, и следующая часть уже не пишется.
+    """
+    if name == "answers":
+        return pa.schema([
+            ("session_id", pa.string()),
+            ("block", pa.int8()),
+            ("question_id", pa.string()),
+            ("group", pa.string()),
+            ("option_ids", pa.list_(pa.string())),
+            ("n_selected", pa.int16()),
+            ("motive", pa.string()),
+            ("lack", pa.string()),
+            ("comment_len", pa.int32()),
+            ("deep_text_len", pa.int32()),
+        ])
+    names = cohort_columns()
+    return pa.schema(
+        [
+            ("id", pa.string()),
+            ("client_name", pa.string()),
+            ("created_at", pa.timestamp("us")),
+            ("started_at", pa.timestamp("us")),
+            ("has_report", pa.bool_()),
+            ("duration_s", pa.float64()),
+        ]
+        + [(c, pa.float64()) for c in names["total"] + names["cols"]]
+    )
+
+
+class ExportSink:
+    """
+    Один файл выгрузки, дописываемый частями: Parquet — row group на часть
+    (схема задана заранее, см. export_schema), CSV — заголовок один раз, списки через «;».
+    """
+
+    def __init__(self, path: str, fmt: str, schema: Optional["pa.Schema"] = None):
+        self.path = path
+        self.fmt = fmt
+        self.schema = schema
+        self.rows = 0
+        self._writer = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.fmt == "parquet":
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, self.schema, compression="zstd")
+            self._writer.write_table(table)
+        else:
+            if "option_ids" in df:
+                df = df.assign(option_ids=df["option_ids"].str.join(";"))
+            df.to_csv(self.path, mode="a", header=not os.path.exists(self.path), index=False, encoding="utf-8")
+        self.rows += len(df)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+
+def export_results(out_path: str, storage: Optional[str] = None, chunk_size: int = EXPORT_CHUNK_DEFAULT,
+                   fmt: Optional[str] = None) -> Dict[str, Any]:
+    """
+    История → zip с sessions.<fmt> и answers.<fmt>. Хранилище читается потоком
+    (iter_all) частями по chunk_size сессий — в памяти одна часть, а не вся история.
+    По умолчанию Parquet, если установлен pyarrow, иначе CSV.
+    """
+    fmt = fmt or ("parquet" if pq is not None else "csv")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unknown export format: {fmt!r}")
+    if fmt == "parquet" and pq is None:
+        raise RuntimeError("Для Parquet нужен pyarrow (pip install pyarrow); либо выгрузи в CSV.")
+    store = make_results_store(storage or results_storage())
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    os.makedirs(out_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    chunks = 0
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp:
+        sinks = {name: ExportSink(os.path.join(tmp, f"{name}.{fmt}"), fmt,
+                                  export_schema(name) if fmt == "parquet" else None)
+                 for name in ("sessions", "answers")}
+        items = iter(store.iter_all())
+        # первая часть пишется, даже если пуста: у пустой истории тоже есть схема/заголовок
+        chunk = list(itertools.islice(items, max(1, chunk_size)))
+        while True:
+            sinks["sessions"].write(export_sessions_frame(chunk))
+            sinks["answers"].write(export_answers_frame(chunk))
+            chunks += 1
+            chunk = list(itertools.islice(items, max(1, chunk_size)))
+            if not chunk:
+                break
+        for sink in sinks.values():
+            sink.close()
+        tmp_zip = os.path.join(tmp, "export.zip")
+        # Parquet уже сжат (zstd) — в zip кладём как есть
+        compression = zipfile.ZIP_STORED if fmt == "parquet" else zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(tmp_zip, "w", compression=compression) as zf:
+            for sink in sinks.values():
+                zf.write(sink.path, arcname=os.path.basename(sink.path))
+        os.replace(tmp_zip, out_path)
+    return {
+        "path": out_path,
+        "format": fmt,
+        "sessions": sinks["sessions"].rows,
+        "answers": sinks["answers"].rows,
+        "chunks": chunks,
+        "bytes": os.path.getsize(out_path),
+        "elapsed_s": round(time.perf_counter() - t0, 3),
+    }
+
+
+def render_export_panel():
+    with st.expander("🗂 Выгрузка всей истории (для анализа в pandas/Excel)"):
+        fmt = "Parquet" if pq is not None else "CSV (pyarrow не установлен)"
+        st.caption(f"Zip: sessions — строка на сессию с баллами, answers — строка на ответ. Формат: {fmt}.")
+        if st.button("Подготовить выгрузку"):
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            for name in os.listdir(EXPORT_DIR):
+                if name.endswith(".zip"):
+                    os.remove(os.path.join(EXPORT_DIR, name))
+            path = os.path.join(EXPORT_DIR, f"deep_identity_export_{datetime.now():%Y%m%d_%H%M%S}.zip")
+            with st.spinner("Выгружаю…"):
+                stats = export_results(path)
+            st.session_state.export_path = path
+            st.caption(f"Сессий {stats['sessions']}, ответов {stats['answers']} · "
+                       f"{stats['bytes'] / 1024:.0f} КБ · {stats['elapsed_s']} с")
+        path = st.session_state.get("export_path")
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                st.download_button("⬇️ Скачать выгрузку", data=f, file_name=os.path.basename(path),
+                                   mime="application/zip")
+
+
+# ============================
+# Пакетная генерация отчётов (asyncio)
+# ============================
+
+BULK_PROGRESS_FILE = "deep_identity_bulk_reports.jsonl"
+
+
+def _retry_after_s(e: Exception) -> Optional[float]:
+    response = getattr(e, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+async def _chat_with_backoff(backend: ReportBackend, req: ReportRequest,
+                             max_attempts: int = 6) -> Tuple[str, Dict[str, Any]]:
+    """429/таймауты/5xx: ждём Retry-After от API, иначе экспоненту с джиттером."""
+    delay = 1.0
+    for attempt in range(max_attempts):
+        try:
+            return await backend.acomplete(req)
+        except RETRYABLE_OPENAI_ERRORS as e:
+            if attempt == max_attempts - 1:
+                raise
+            await asyncio.sleep(_retry_after_s(e) or delay * (1 + random.random() / 4))
+            delay = min(delay * 2, 60.0)
+    raise RuntimeError("unreachable")
+
+
+def _bulk_read_progress() -> Dict[str, Dict[str, Any]]:
+    """Готовые, но ещё не записанные в хранилище черновики прошлого прерванного запуска."""
+    done: Dict[str, Dict[str, Any]] = {}
+    if os.path.exists(BULK_PROGRESS_FILE):
+        for item in JsonlResultsStore(BULK_PROGRESS_FILE).load_all():
+            done[item["id"]] = item
+    return done
+
+
+def bulk_generate_reports(concurrency: int = 4, batch_size: int = 10, limit: Optional[int] = None,
+                          on_progress: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Черновики для всех сессий с пустым master_report.draft_text.
+    Одновременно не больше concurrency запросов; каждый готовый черновик сразу
+    дописывается в BULK_PROGRESS_FILE (оплаченная работа не теряется при падении),
+    в хранилище пишется пачками по batch_size через update_many.
+    on_progress(done, total) — для прогресс-бара.
+    """
+    backend = get_report_backend()
+    if backend is None:
+        raise RuntimeError(OPENAI_UNAVAILABLE)
+    model = backend.model
+    store = get_results_store()
+    cache = get_report_cache()
+    recovered = _bulk_read_progress()
+
+    todo = [x for x in store.iter_all()
+            if not ((x.get("master_report") or {}).get("draft_text")) and x.get("id") not in recovered]
+    if limit:
+        todo = todo[:limit]
+    total = len(todo)
+    pending: List[Dict[str, Any]] = list(recovered.values())
+    stats = {"total": total, "generated": 0, "cached": 0, "failed": 0, "recovered": len(recovered), "errors": []}
+
+    def write_batch(batch: List[Dict[str, Any]]) -> None:
+        # синхронная запись — вызывается из потока, а не из цикла событий
+        by_id = {x["id"]: x["master_report"] for x in batch}
+
+        def merge(sess: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            # мастер мог успеть сгенерировать отчёт вручную — его не трогаем;
+            # проверка и запись под одним замком хранилища (modify_many)
+            if (sess.get("master_report") or {}).get("draft_text"):
+                return None
+            sess["master_report"] = {**(sess.get("master_report") or {}), **by_id[sess["id"]]}
+            return sess
+
+        store.modify_many(list(by_id), merge)
+
+    async def record(sess: Dict[str, Any], draft: str, rows_override: Dict[str, Any], metrics: Dict[str, Any]) -> None:
+        item = {"id": sess["id"], "master_report": {
+            "draft_text": draft, "generated_at": _now_iso(), "rows_override": rows_override,
+            "partial": False, "metrics": metrics}}
+        # fsync журнала и запись пачки блокируют — пока они идут, остальные запросы продолжают работать
+        await asyncio.to_thread(JsonlResultsStore(BULK_PROGRESS_FILE).append, item)
+        pending.append(item)
+        if len(pending) >= batch_size:
+            batch = pending[:]
+            pending.clear()
+            await asyncio.to_thread(write_batch, batch)
+
+    async def run() -> None:
+        sem = asyncio.Semaphore(max(1, concurrency))
+
+        async def one(sess: Dict[str, Any]) -> Tuple[Dict[str, Any], Any, Dict[str, Any], Dict[str, Any]]:
+            scores = sess.get("scores") or {}
+            row1, row2, row3, table = build_master_table_default(scores.get("combined_total") or {}, scores.get("block3_cols") or {})
+            rows_override = {"row1": row1, "row2": row2, "row3": row3, "table": table}
+            messages = report_messages(sess, table)
+            key = report_cache_key(backend.cache_model(), messages)
+            metrics: Dict[str, Any] = {"backend": backend.name, "model": model, "streamed": False,
+                                       "cached": False, "bulk": True, **prompt_budget_metrics(messages)}
+            cached = await asyncio.to_thread(cache.get, key)
+            if cached:
+                metrics["cached"] = True
+                return sess, cached, rows_override, metrics
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    draft, usage = await _chat_with_backoff(backend, ReportRequest(sess, table, messages))
+                except Exception as e:
+                    return sess, e, rows_override, metrics
+                metrics["total_s"] = round(time.perf_counter() - t0, 3)
+                metrics.update(usage)
+            if draft:
+                await asyncio.to_thread(cache.put, key, draft, model)
+            return sess, draft, rows_override, metrics
+
+        try:
+            done = 0
+            for fut in asyncio.as_completed([one(x) for x in todo]):
+                sess, draft, rows_override, metrics = await fut
+                done += 1
+                if isinstance(draft, Exception) or not draft:
+                    stats["failed"] += 1
+                    stats["errors"].append(f"{sess.get('id')}: {draft}")
+                else:
+                    stats["cached" if metrics["cached"] else "generated"] += 1
+                    await record(sess, draft, rows_override, metrics)
+                if on_progress:
+                    on_progress(done, total)
+        finally:
+            await backend.aclose()
+
+    t0 = time.perf_counter()
+    asyncio.run(run())
+    if pending:
+        write_batch(pending)
+    # всё записано в хранилище — журнал прогресса (и его .lock от results_write_lock) больше не нужен
+    for fn in (BULK_PROGRESS_FILE, BULK_PROGRESS_FILE + ".lock"):
+        if os.path.exists(fn):
+            os.remove(fn)
+    stats["elapsed_s"] = round(time.perf_counter() - t0, 3)
+    return stats
+
+
+# ============================
+# Пересчёт баллов всей истории (без UI)
+# ============================
+
+def _rescore_chunk(answers_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    engine = get_scoring_engine()
+    tensor = engine.score_batch([engine.selection(a) for a in answers_list])
+    return [scores_from_tensor(t) for t in tensor]
+
+
+def _chunks(it: Iterator[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def rescore_all_results(processes: int = 0, chunk_size: int = 500, write_batch: int = 5000,
+                        dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Пересчитывает scores всех сохранённых сессий по их answers
+    текущими весами (build_block*_questions, MOTIVE_TO_POT, LACK_TO_HINT).
+    Пачки сессий считаются в пуле процессов; изменившиеся записи
+    пишутся обратно через update_many пачками по write_batch.
+    """
+    store = get_results_store()
+    processes = processes or (os.cpu_count() or 1)
+    total = changed = 0
+    pending: List[Dict[str, Any]] = []
+    t0 = time.perf_counter()
+
+    def collect(sessions: List[Dict[str, Any]], new_scores: List[Dict[str, Any]]) -> None:
+        nonlocal total, changed
+        for sess, scores in zip(sessions, new_scores):
+            total += 1
+            if sess.get("scores") != scores:
+                changed += 1
+                sess["scores"] = scores
+                pending.append(sess)
+
+    def flush(force: bool = False) -> None:
+        if pending and (force or len(pending) >= write_batch):
+            if not dry_run:
+                store.update_many(pending)
+            pending.clear()
+
+    chunks = _chunks(store.iter_all(), chunk_size)
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            in_flight: List[Tuple[List[Dict[str, Any]], Any]] = []
+            for chunk in chunks:
+                in_flight.append((chunk, pool.submit(_rescore_chunk, [x.get("answers") or {} for x in chunk])))
+                # не держим в памяти больше 2×processes пачек
+                while len(in_flight) >= 2 * processes:
+                    done_chunk, fut = in_flight.pop(0)
+                    collect(done_chunk, fut.result())
+                    flush()
+            for done_chunk, fut in in_flight:
+                collect(done_chunk, fut.result())
+                flush()
+    else:
+        for chunk in chunks:
+            collect(chunk, _rescore_chunk([x.get("answers") or {} for x in chunk]))
+            flush()
+    flush(force=True)
+
+    elapsed = time.perf_counter() - t0
+    return {
+        "sessions": total,
+        "changed": changed,
+        "dry_run": dry_run,
+        "elapsed_s": round(elapsed, 3),
+        "sessions_per_s": round(total / elapsed, 1) if elapsed else None,
+    }
+
+
+# ============================
+# Локальный OpenAI-совместимый стаб (для бенчмарков)
+# ============================
+
+class _StubChatHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions → детерминированный ответ после server.delay секунд."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive: иначе переиспользовать нечего
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        server: Any = self.server
+        with server.lock:
+            server.requests += 1
+            limited = server.rate_limit_every and server.requests % server.rate_limit_every == 0
+        if limited:
+            payload = b'{"error": {"message": "stub rate limit", "type": "rate_limit_exceeded"}}'
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Retry-After", "0.05")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        time.sleep(server.delay)
+        messages = body.get("messages", [])
+        prompt = "\n".join(str(m.get("content", "")) for m in messages)
+        text = f"[stub] черновик отчёта ({len(prompt)} симв. промпта)"
+        # как у провайдера: повторно присланное системное сообщение считается закэшированным
+        system = str(messages[0].get("content", "")) if messages else ""
+        with server.lock:
+            cached = len(system) // 4 if system in server.seen_prefixes else 0
+            server.seen_prefixes.add(system)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4,
+                 "total_tokens": (len(prompt) + len(text)) // 4,
+                 "prompt_tokens_details": {"cached_tokens": cached}}
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self._send_stream(body.get("model", "stub"), text, usage if include_usage else None)
+            return
+        payload = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        }, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_stream(self, model: str, text: str, usage: Optional[Dict[str, Any]] = None) -> None:
+        # SSE без Content-Length: соединение закрываем после [DONE]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for piece in re.findall(r"\S+\s*", text):
+            event = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        if usage:
+            event = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+@contextmanager
+def stub_openai_server(delay: float = 0.0, rate_limit_every: int = 0):
+    """
+    Поднимает стаб на 127.0.0.1:<свободный порт>, отдаёт base_url.
+    rate_limit_every=N — каждый N-й запрос получает 429 с Retry-After.
+    """
+    server: Any = ThreadingHTTPServer(("127.0.0.1", 0), _StubChatHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.rate_limit_every = rate_limit_every
+    server.requests = 0
+    server.seen_prefixes = set()
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# ============================
+# Бенчмарки (запускаются из CLI)
+# ============================
+
+def bench_session(seed: int = 0) -> Dict[str, Any]:
+    """Синтетическая сессия: по одному-два варианта на каждый вопрос всех блоков."""
+    rnd = random.Random(seed)
+    bank = get_question_bank()
+    answers: Dict[str, Dict[str, Any]] = {"block1": {}, "block2": {}, "block3": {}}
+    for q in list(bank.b1.values()) + list(bank.b2) + list(bank.b3):
+        k = rnd.randint(1, 2) if q.allow_multiple else 1
+        picked = rnd.sample(range(len(q.options)), min(k, len(q.options)))
+        a = {
+            "question": q.text,
+            **selected_payload(q, picked),
+            "comment": rnd.choice(["", "", "Люблю, когда всё работает как часы."]),
+            "deep": {"motive": rnd.choice(MOTIVE_OPTIONS)[0], "lack": rnd.choice(LACK_OPTIONS)[0], "deep_text": ""},
+        }
+        if q.block == 3:
+            a["group"] = q.group
+        answers[f"block{q.block}"][q.id] = a
+    session = {
+        "id": f"bench-{seed}",
+        "created_at": _now_iso(),
+        "client_name": f"Клиент {seed}",
+        "client_contact": "",
+        "answers": answers,
+        "master_report": {"generated_at": None, "draft_text": "", "rows_override": None},
+    }
+    session["scores"] = rescore_sessions([session])[0]
+    return session
+
+
+def _latency_stats(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 2),
+        "p50_ms": round(1000 * ordered[len(ordered) // 2], 2),
+        "max_ms": round(1000 * ordered[-1], 2),
+    }
+
+
+def bench_openai_client(n: int, delay: float) -> Dict[str, Any]:
+    """
+    Латентность generate_master_report против локального стаба:
+    cold — клиент создаётся заново на каждый отчёт (как было), warm — общий клиент.
+    """
+    session = bench_session()
+    _, _, _, table = build_master_table_default(session["scores"]["combined_total"], session["scores"]["block3_cols"])
+    saved = {k: os.environ.get(k) for k in ("OPENAI_API_KEY", "OPENAI_BASE_URL")}
+    out: Dict[str, Any] = {"reports": n, "server_delay_ms": round(delay * 1000, 1)}
+    try:
+        with stub_openai_server(delay) as base_url:
+            os.environ["OPENAI_API_KEY"] = "stub"
+            os.environ["OPENAI_BASE_URL"] = base_url
+            for mode in ("cold", "warm"):
+                _openai_client.clear()
+                samples = []
+                for _ in range(n):
+                    if mode == "cold":
+                        _openai_client.clear()
+                    t0 = time.perf_counter()
+                    # без кэша: иначе все вызовы после первого — попадания в диск, а не HTTP-клиент
+                    draft = generate_master_report(session, table, use_cache=False)
+                    samples.append(time.perf_counter() - t0)
+                    if draft.startswith("⚠️"):
+                        raise RuntimeError(draft)
+                out[mode] = _latency_stats(samples)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    return out
+
+
+def bench_report_backend(name: str, n: int, concurrency: int, delay: float, url: str = "",
+                         rate_limit_every: int = 0) -> Dict[str, Any]:
+    """
+    Сквозной путь отчёта (таблица → промпт → бэкенд) без сети и без денег:
+    stub — шаблон в процессе, local — HTTP-адаптер против локального стаба
+    (или настоящего сервера, если задан url). Кэш отчётов не используется.
+    rate_limit_every=N — стаб отвечает 429 на каждый N-й запрос (проверка повторов клиента).
+    """
+    sessions = [bench_session(i) for i in range(n)]
+    tables = [build_master_table_default(x["scores"]["combined_total"], x["scores"]["block3_cols"])[3] for x in sessions]
+    server = stub_openai_server(delay, rate_limit_every) if name == "local" and not url else None
+    try:
+        if name == "stub":
+            backend: ReportBackend = StubReportBackend(delay)
+        else:
+            base_url = url or server.__enter__()
+            backend = LocalHTTPReportBackend("local", base_url, get_setting("REPORT_LOCAL_MODEL", "local"),
+                                             *openai_limits())
+
+        def one(i: int) -> float:
+            t0 = time.perf_counter()
+            draft = generate_master_report(sessions[i], tables[i], use_cache=False, backend=backend)
+            if draft.startswith("⚠️"):
+                raise RuntimeError(draft)
+            return time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            samples = list(pool.map(one, range(n)))
+        elapsed = time.perf_counter() - t0
+    finally:
+        if server is not None:
+            server.__exit__(None, None, None)
+    return {"backend": name, "reports": n, "concurrency": concurrency, "delay_ms": round(delay * 1000, 1),
+            "rate_limit_every": rate_limit_every if server is not None else 0,
+            "reports_per_s": round(n / elapsed, 1), **_latency_stats(samples)}
+
+
+def _bench_row_bruteforce(row_pots: List[str], col_scores: Dict[str, Dict[str, float]]) -> Dict[str, str]:
+    """
+    Эталон для bench-tables — прежний перебор 6 перестановок ряда (в приложении его
+    заменили solve_tables/batch_tables): {"c1": pot, "c2": pot, "c3": pot} с максимальной суммой столбцов.
+    """
+    cols = ["c1", "c2", "c3"]
+    best_map = None
+    best_sum = -1e9
+    for perm in itertools.permutations(row_pots, 3):
+        s = 0.0
+        for c, pot in zip(cols, perm):
+            s += float(col_scores.get(pot, {}).get(c, 0.0))
+        if s > best_sum:
+            best_sum = s
+            best_map = dict(zip(cols, perm))
+    return best_map or {"c1": row_pots[0], "c2": row_pots[1], "c3": row_pots[2]}
+
+
+def bench_tables(synthetic: int = 0, k: int = 5) -> Dict[str, Any]:
+    """
+    Таблицы 3×3 для всей истории (или synthetic синтетических сессий):
+    прежний перебор по рядам, венгерский алгоритм по одной таблице, batch_tables
+    на всю пачку и топ-k альтернатив при свободных рядах.
+    """
+    if synthetic:
+        scores = [bench_session(i)["scores"] for i in range(synthetic)]
+    else:
+        scores = [x["scores"] for x in iter_results(["scores.combined_total", "scores.block3_cols"])
+                  if (x.get("scores") or {}).get("block3_cols")]
+    if not scores:
+        return {"sessions": 0}
+    rows = [build_master_table_default(x["combined_total"], x["block3_cols"])[:3] for x in scores]
+
+    def total(table: List[List[str]], cols: Dict[str, Dict[str, float]]) -> float:
+        return sum(float(cols[p][c]) for row in table for p, c in zip(row, TABLE_COLS))
+
+    t0 = time.perf_counter()
+    old = [[[m[c] for c in TABLE_COLS] for m in (_bench_row_bruteforce(r, x["block3_cols"]) for r in rs)]
+           for rs, x in zip(rows, scores)]
+    t_old = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    new = [solve_tables(x["block3_cols"], rows=list(rs))[0].rows() for rs, x in zip(rows, scores)]
+    t_new = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    batch = batch_tables(np.array([[[POT_INDEX[p] for p in r] for r in rs] for rs in rows]),
+                         np.stack([column_matrix(x["block3_cols"]) for x in scores]))
+    t_batch = time.perf_counter() - t0
+    batch_tables_ = [[[POTENTIALS[i] for i in r] for r in t] for t in batch.tolist()]
+    t0 = time.perf_counter()
+    for x in scores:
+        solve_tables(x["block3_cols"], x["combined_total"], k=k)
+    t_top = time.perf_counter() - t0
+    n = len(scores)
+    return {
+        "sessions": n,
+        "bruteforce_us": round(1e6 * t_old / n, 1),
+        "hungarian_us": round(1e6 * t_new / n, 1),
+        "batch_numpy_us": round(1e6 * t_batch / n, 1),
+        f"top{k}_free_us": round(1e6 * t_top / n, 1),
+        "same_table": sum(a == b for a, b in zip(old, new)),
+        "batch_same_table": sum(a == b for a, b in zip(old, batch_tables_)),
+        "same_score": sum(abs(total(a, x["block3_cols"]) - total(b, x["block3_cols"])) < 1e-6
+                          for a, b, x in zip(old, new, scores)),
+    }
+
+
+def _bench_append_worker(args: Tuple[str, int, int, int]) -> int:
+    workdir, worker_no, count, threads = args
+    os.chdir(workdir)
+
+    def one(i: int) -> None:
+        append_result({
+            "id": f"bench-{worker_no}-{i}",
+            "created_at": _now_iso(),
+            "client_name": f"bench {worker_no}",
+            "client_contact": "",
+            "answers": {"block1": {}, "block2": {}, "block3": {}},
+            "scores": {"combined_total": {p: 0.0 for p in POTENTIALS}},
+            "master_report": {"generated_at": None, "draft_text": "", "rows_override": None},
+        })
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(count)))
+    return count
+
+
+def bench_concurrent_writes(storage: str, total: int, threads: int, processes: int) -> Dict[str, Any]:
+    """
+    Стресс-тест: total одновременных append_result во временной папке
+    (processes процессов × threads потоков) и проверка, что ни одна запись не потерялась.
+    """
+    prev_cwd = os.getcwd()
+    prev_storage = os.environ.get("RESULTS_STORAGE")
+    os.environ["RESULTS_STORAGE"] = storage
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            per_proc = [total // processes + (1 if i < total % processes else 0) for i in range(processes)]
+            jobs = [(workdir, i, n, threads) for i, n in enumerate(per_proc)]
+            t0 = time.perf_counter()
+            if processes > 1:
+                with ProcessPoolExecutor(max_workers=processes) as pool:
+                    list(pool.map(_bench_append_worker, jobs))
+            else:
+                _bench_append_worker(jobs[0])
+            elapsed = time.perf_counter() - t0
+            os.chdir(workdir)
+            stored = {x.get("id") for x in load_results()}
+    finally:
+        os.chdir(prev_cwd)
+        if prev_storage is None:
+            os.environ.pop("RESULTS_STORAGE", None)
+        else:
+            os.environ["RESULTS_STORAGE"] = prev_storage
+    return {
+        "storage": storage,
+        "expected": total,
+        "stored": len(stored),
+        "lost": total - len(stored),
+        "elapsed_s": round(elapsed, 3),
+        "writes_per_s": round(total / elapsed, 1) if elapsed else None,
+    }
+
+
+def _measure_alloc(make: Any, n: int) -> int:
+    """Сколько байт удерживают n объектов, созданных make() (tracemalloc)."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        kept = [make() for _ in range(n)]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del kept
+    return size
+
+
+@dataclass
+class _LegacyAnswerOption:
+    """Вариант ответа до общего реестра: обычный dataclass, баллы словарём, списки."""
+    text: str
+    score_changes: Dict[str, float] = field(default_factory=dict)
+    inject_questions: List[str] = field(default_factory=list)
+    tags: List[str] = field(default_factory=list)
+
+
+@dataclass
+class _LegacyQuestion:
+    id: str
+    text: str
+    block: int
+    group: str = ""
+    allow_multiple: bool = False
+    allow_comment: bool = True
+    options: List[_LegacyAnswerOption] = field(default_factory=list)
+
+
+def _legacy_question(q: Question) -> _LegacyQuestion:
+    # строки — те же объекты (как литералы в прежних build_*), свои у копии только контейнеры
+    options = [_LegacyAnswerOption(o.text, {p: v for p, v in zip(POTENTIALS, o.score_changes) if v},
+                                   list(o.inject_questions), list(o.tags)) for o in q.options]
+    return _LegacyQuestion(q.id, q.text, q.block, q.group, q.allow_multiple, q.allow_comment, options)
+
+
+def bench_session_memory(sessions: int) -> Dict[str, Any]:
+    """
+    Память на одну клиентскую сессию: как было (в каждой session_state свои банки
+    вопросов в прежнем представлении — _LegacyQuestion/_LegacyAnswerOption)
+    и как стало (только ответы/курсоры + общий реестр).
+    """
+    bank = build_question_bank()
+
+    def legacy_state() -> Dict[str, Any]:
+        state = initial_session_state()
+        state["b1_questions"] = {qid: _legacy_question(q) for qid, q in bank.b1.items()}
+        state["b2_questions"] = [_legacy_question(q) for q in bank.b2]
+        state["b3_questions"] = [_legacy_question(q) for q in bank.b3]
+        return state
+
+    registry = _measure_alloc(build_question_bank, 1)
+    before = _measure_alloc(legacy_state, sessions)
+    after = _measure_alloc(initial_session_state, sessions)
+    return {
+        "sessions": sessions,
+        "per_session_before_bytes": before // sessions,
+        "per_session_after_bytes": after // sessions,
+        "registry_once_bytes": registry,
+    }
+
+
+BENCH_LOAD_MODES = ("baseline", "load_all", "iter_all", "iter_fields")
+
+
+def _bench_load_worker(path: str, mode: str) -> Dict[str, Any]:
+    """Один способ построить индекс мастер-панели по JSON-файлу; пиковый RSS — своего процесса."""
+    import resource  # только POSIX; бенчмарк служебный
+    store = JsonResultsStore(path)
+    t0 = time.perf_counter()
+    if mode == "load_all":
+        summaries = [session_summary(x) for x in store.load_all()]
+    elif mode == "iter_all":
+        summaries = [session_summary(x) for x in store.iter_all()]
+    elif mode == "iter_fields":
+        summaries = [session_summary(x) for x in store.iter_all(SESSION_SUMMARY_FIELDS)]
+    else:
+        summaries = []
+    return {
+        "sessions": len(summaries),
+        "elapsed_s": round(time.perf_counter() - t0, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def bench_load(sizes: List[int]) -> Dict[str, Any]:
+    """
+    Пиковый RSS против размера RESULTS_FILE: json.load всей истории vs потоковый iter_all
+    (с проекцией полей и без). Каждый замер — отдельный процесс, baseline — просто импорт модуля.
+    """
+    templates = [bench_session(i) for i in range(20)]
+    out: Dict[str, Any] = {"modes": list(BENCH_LOAD_MODES), "runs": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            path = os.path.join(tmp, f"results_{n}.json")
+            JsonResultsStore(path)._write({**templates[i % len(templates)], "id": f"bench-{i}"} for i in range(n))
+            run: Dict[str, Any] = {"sessions": n, "file_mb": round(os.path.getsize(path) / 2 ** 20, 1)}
+            for mode in BENCH_LOAD_MODES:
+                res = subprocess.run([sys.executable, os.path.abspath(__file__), "bench-load", "--worker", mode,
+                                      "--path", path], capture_output=True, text=True, check=True)
+                run[mode] = json.loads(res.stdout.strip().splitlines()[-1])
+            out["runs"].append(run)
+            os.remove(path)
+    return out
+
+
+# ============================
+# CLI (служебные команды без UI)
+# ============================
+
+def cli(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="deep_identity_app.py")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("migrate-jsonl", help=f"перенести {RESULTS_FILE} в {RESULTS_JSONL_FILE}")
+    sub.add_parser("migrate-sqlite", help=f"перенести {RESULTS_FILE} в {RESULTS_DB_FILE}")
+    sub.add_parser("compact-jsonl", help=f"оставить по одной версии записи в {RESULTS_JSONL_FILE}")
+    sub.add_parser("compact-events", help=f"законченные сессии из {SESSION_EVENTS_DIR}/ — в хранилище результатов")
+    p_bw = sub.add_parser("bench-writes", help="стресс-тест параллельных append_result")
+    p_bw.add_argument("--storage", choices=RESULTS_STORAGES, default="json")
+    p_bw.add_argument("--n", type=int, default=300, help="сколько записей всего")
+    p_bw.add_argument("--threads", type=int, default=32)
+    p_bw.add_argument("--processes", type=int, default=1)
+    p_rs = sub.add_parser("rescore", help="пересчитать scores всех сессий текущими весами")
+    p_rs.add_argument("--processes", type=int, default=0, help="0 = по числу CPU")
+    p_rs.add_argument("--chunk-size", type=int, default=500)
+    p_rs.add_argument("--write-batch", type=int, default=5000)
+    p_rs.add_argument("--dry-run", action="store_true", help="только посчитать, ничего не записывать")
+    p_br = sub.add_parser("bulk-reports", help="черновики отчётов для всех сессий без отчёта")
+    p_br.add_argument("--concurrency", type=int, default=4)
+    p_br.add_argument("--batch", type=int, default=10, help="сколько черновиков писать в хранилище за раз")
+    p_br.add_argument("--limit", type=int, default=0, help="0 = все")
+    p_bo = sub.add_parser("bench-openai", help="латентность отчёта: новый клиент vs общий (локальный стаб)")
+    p_bo.add_argument("--n", type=int, default=50)
+    p_bo.add_argument("--delay-ms", type=float, default=0.0, help="искусственная задержка стаба")
+    p_bb = sub.add_parser("bench-reports", help="пропускная способность/латентность отчётов офлайн")
+    p_bb.add_argument("--backend", choices=("stub", "local"), default="stub")
+    p_bb.add_argument("--n", type=int, default=100)
+    p_bb.add_argument("--concurrency", type=int, default=4)
+    p_bb.add_argument("--delay-ms", type=float, default=0.0, help="искусственная задержка генерации")
+    p_bb.add_argument("--url", default="", help="настоящий OpenAI-совместимый сервер вместо стаба")
+    p_bb.add_argument("--rate-limit-every", type=int, default=0,
+                      help="local: стаб отвечает 429 на каждый N-й запрос (0 = никогда)")
+    p_bt = sub.add_parser("bench-tables", help="таблицы 3×3 для всей истории: перебор vs венгерский алгоритм")
+    p_bt.add_argument("--synthetic", type=int, default=0, help="вместо истории — N синтетических сессий")
+    p_bt.add_argument("--k", type=int, default=5, help="сколько альтернатив считать")
+    p_ex = sub.add_parser("export", help="выгрузить историю в zip (Parquet/CSV) частями")
+    p_ex.add_argument("--out", default="deep_identity_export.zip")
+    p_ex.add_argument("--format", choices=EXPORT_FORMATS, default=None, help="по умолчанию parquet, если есть pyarrow")
+    p_ex.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_DEFAULT)
+    p_bl = sub.add_parser("bench-load", help="пиковая память: json.load истории vs потоковое чтение")
+    p_bl.add_argument("--sizes", default="1000,5000,10000", help="сколько сессий в файле, через запятую")
+    p_bl.add_argument("--worker", choices=BENCH_LOAD_MODES, help=argparse.SUPPRESS)
+    p_bl.add_argument("--path", help=argparse.SUPPRESS)
+    p_bm = sub.add_parser("bench-session-memory", help="память на одну сессию до/после реестра вопросов")
+    p_bm.add_argument("--sessions", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    if args.cmd in ("migrate-jsonl", "migrate-sqlite"):
+        mode = args.cmd.split("-", 1)[1]
+        target = make_results_store(mode)
+        moved = migrate_results(target)
+        print(f"Перенесено записей: {moved} → {target.path}")
+        print(f"Чтобы приложение читало новый бэкенд, задай RESULTS_STORAGE=\"{mode}\".")
+    elif args.cmd == "compact-jsonl":
+        kept = JsonlResultsStore().compact()
+        print(f"Записей после сжатия: {kept}")
+    elif args.cmd == "compact-events":
+        print(json.dumps(compact_session_events(), ensure_ascii=False))
+    elif args.cmd == "rescore":
+        res = rescore_all_results(processes=args.processes, chunk_size=max(1, args.chunk_size),
+                                  write_batch=max(1, args.write_batch), dry_run=args.dry_run)
+        print(json.dumps(res, ensure_ascii=False))
+    elif args.cmd == "bulk-reports":
+        stats = bulk_generate_reports(concurrency=args.concurrency, batch_size=max(1, args.batch),
+                                      limit=args.limit or None,
+                                      on_progress=lambda d, t: print(f"\r{d}/{t}", end="", file=sys.stderr))
+        print(file=sys.stderr)
+        print(json.dumps(stats, ensure_ascii=False))
+        return 0 if stats["failed"] == 0 else 1
+    elif args.cmd == "bench-writes":
+        res = bench_concurrent_writes(args.storage, args.n, args.threads, max(1, args.processes))
+        print(json.dumps(res, ensure_ascii=False))
+        return 0 if res["lost"] == 0 else 1
+    elif args.cmd == "bench-openai":
+        print(json.dumps(bench_openai_client(max(1, args.n), args.delay_ms / 1000), ensure_ascii=False))
+    elif args.cmd == "bench-reports":
+        res = bench_report_backend(args.backend, max(1, args.n), max(1, args.concurrency),
+                                   args.delay_ms / 1000, args.url, max(0, args.rate_limit_every))
+        print(json.dumps(res, ensure_ascii=False))
+    elif args.cmd == "bench-tables":
+        print(json.dumps(bench_tables(max(0, args.synthetic), max(1, args.k)), ensure_ascii=False))
+    elif args.cmd == "export":
+        print(json.dumps(export_results(args.out, chunk_size=args.chunk_size, fmt=args.format), ensure_ascii=False))
+    elif args.cmd == "bench-load":
+        if args.worker:
+            print(json.dumps(_bench_load_worker(args.path, args.worker)))
+        else:
+            sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+            print(json.dumps(bench_load(sizes), ensure_ascii=False))
+    elif args.cmd == "bench-session-memory":
+        print(json.dumps(bench_session_memory(max(1, args.sessions)), ensure_ascii=False))
+    return 0
+
+
+CLI_COMMANDS = ("migrate-jsonl", "migrate-sqlite", "compact-jsonl", "compact-events", "rescore", "bulk-reports",
+                "export", "bench-writes", "bench-session-memory", "bench-load", "bench-openai", "bench-reports",
+                "bench-tables")
+
 
 # ============================
 # Основной роутер
@@ -1634,10 +5146,15 @@ def main():
         if not master_auth_ok():
             st.warning("Введи пароль мастера в сайдбаре.")
             return
-        render_master()
+        page = st.sidebar.radio("Раздел", options=["Клиенты", "Аналитика"], index=0)
+        if page == "Аналитика":
+            render_analytics()
+        else:
+            render_master()
         return
 
     # CLIENT FLOW
+    resume_session_from_link()
     if st.session_state.current_block == 0:
         render_welcome()
     elif st.session_state.current_block == 1:
@@ -1651,4 +5168,6 @@ def main():
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(cli(sys.argv[1:]))
     main()